@@ -0,0 +1,403 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+....................Local place-name index for PLAYGROUNDr web app..............
+Author: James Bramante
+Date: February 26, 2020
+
+This module contains the Gazetteer class, a local index of normalized place
+name queries and their coordinates. The web app checks it before asking
+Google to geocode a location typed into the location bar, and adds Google's
+answers to it, so repeated searches for the same neighborhood names don't
+cost a remote round trip. It can also be seeded from an offline place-name
+file, and supports prefix lookups for autocomplete.
+
+Google's answers are kept for at most max_age seconds (Google allows caching
+coordinates for a limited period), and at most max_entries of them are kept,
+oldest dropped first. Autocomplete only shows Google's name for a place, or
+the seed file's, never the text that was typed.
+"""
+
+from collections import OrderedDict
+import bisect
+import csv
+import json
+import os
+import re
+import threading
+import time
+
+class Gazetteer(object):
+    """A local index of place name queries and their coordinates
+
+    Attributes
+    ----------
+    DEFAULT_MAX_AGE : float
+        seconds to keep Google's answers, if not supplied to init
+    DEFAULT_MAX_ENTRIES : int
+        number of Google's answers to keep, if not supplied to init
+    filename : str
+        JSON lines file to which new entries are appended, shared by all
+        workers. None keeps entries in memory only
+    max_age : float
+        seconds after which entries from Google expire
+    max_entries : int
+        maximum number of entries from Google to keep
+    entries : dict
+        normalized query : {'query', 'name', 'lat', 'lng', 'time'} dict. The
+        time is None for seeded entries, which don't expire
+    hits : int
+        number of lookups answered from the index
+    misses : int
+        number of lookups not found in the index
+    remote_lookups : int
+        number of misses passed to the fallback geocoder
+    evicted : int
+        number of entries dropped because they expired or exceeded max_entries
+
+    Methods
+    -------
+    normalize(query):
+        Normalize a place name query for indexing
+    lookup(self, query):
+        Find the coordinates for a query in the index
+    add(self, query, location, name=None, persist=True, seeded=False):
+        Add a query and its coordinates to the index
+    geocode(self, query, fallback):
+        Find the coordinates for a query, falling back to a remote geocoder
+    prefix(self, text, limit=10):
+        List indexed places whose normalized query starts with some text
+    load_seed(self, seed_filename):
+        Add places from an offline place-name CSV file
+    stats(self):
+        Summarize the index size and hit rate
+    """
+
+    QUERY_SYMBOLS_RE = re.compile('[^0-9a-z ]') # Symbols to remove from queries
+    DEFAULT_MAX_AGE = 30*24*3600 # Seconds to keep Google's answers
+    DEFAULT_MAX_ENTRIES = 10000 # Number of Google's answers to keep
+
+    def __init__(self, filename=None, seed_filename=None, max_age=DEFAULT_MAX_AGE, max_entries=DEFAULT_MAX_ENTRIES):
+        """
+        Parameters
+        ----------
+        filename : str, optional
+            JSON lines file in which to persist entries. Existing entries are
+            loaded. The default is to keep entries in memory only.
+        seed_filename : str, optional
+            offline place-name CSV file to load (see load_seed)
+        max_age : float, optional
+            seconds after which entries from Google expire. The default is
+            DEFAULT_MAX_AGE.
+        max_entries : int, optional
+            maximum number of entries from Google to keep. The file is
+            rewritten without dropped entries once it holds twice as many
+            lines. The default is DEFAULT_MAX_ENTRIES.
+
+        Returns
+        -------
+        None.
+
+        """
+
+        super(Gazetteer, self).__init__()
+        self.filename = filename
+        self.max_age = max_age
+        self.max_entries = max_entries
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+        self.remote_lookups = 0
+        self.evicted = 0
+        self._keys = [] # Sorted normalized queries, for prefix lookups
+        self._remote = OrderedDict() # Queries of entries from Google, oldest first
+        self._lock = threading.Lock()
+        self._file_offset = 0
+        self._file_lines = 0
+        self._file_header = None # First line of filename, which _compact changes
+        if seed_filename and os.path.isfile(seed_filename):
+            self.load_seed(seed_filename)
+        self._sync()
+
+    @classmethod
+    def normalize(cls, query):
+        """Normalize a place name query for indexing
+
+        Parameters
+        ----------
+        query : str
+            place name query, e.g. as typed into the location bar
+
+        Returns
+        -------
+        str
+            lowercased query with symbols removed and whitespace collapsed
+
+        """
+        return ' '.join(re.sub(cls.QUERY_SYMBOLS_RE, ' ', str(query).lower()).split())
+
+    def lookup(self, query):
+        """Find the coordinates for a query in the index
+
+        Parameters
+        ----------
+        query : str
+            place name query
+
+        Returns
+        -------
+        dict
+            {'lat', 'lng'} coordinates, or None if the query is not indexed
+
+        """
+        key = self.normalize(query)
+        entry = self.entries.get(key)
+        if entry is None:
+            # Another worker may have added it since we last read the file
+            self._sync()
+            entry = self.entries.get(key)
+        with self._lock:
+            self._expire()
+            if entry is not None and (self.entries.get(key) is not entry or self._expired(entry)):
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return {'lat' : entry['lat'], 'lng' : entry['lng']}
+
+    def add(self, query, location, name=None, persist=True, seeded=False):
+        """Add a query and its coordinates to the index
+
+        Parameters
+        ----------
+        query : str
+            place name query
+        location : dict
+            {'lat', 'lng'} coordinates
+        name : str, optional
+            display name for autocomplete, e.g. Google's name for the place.
+            Entries without one are not suggested. The default is None.
+        persist : bool, optional
+            whether to append the entry to filename. The default is True.
+        seeded : bool, optional
+            whether the entry is from an offline place-name file, and so
+            never expires. The default is False.
+
+        Returns
+        -------
+        None.
+
+        """
+        key = self.normalize(query)
+        if not key:
+            return
+        entry = {'query' : key, 'name' : name or None,
+                 'lat' : float(location['lat']), 'lng' : float(location['lng']),
+                 'time' : None if seeded else time.time()}
+        with self._lock:
+            self._insert(entry)
+            if persist and self.filename:
+                # One short append per entry, so concurrent workers don't
+                # interleave partial lines
+                with open(self.filename, 'a') as fp:
+                    fp.write(json.dumps(entry) + '\n')
+
+    def geocode(self, query, fallback):
+        """Find the coordinates for a query, falling back to a remote geocoder
+
+        Parameters
+        ----------
+        query : str
+            place name query
+        fallback : function
+            called with the query on a miss. Should return {'lat', 'lng'}
+            coordinates, and optionally the place's 'name' as the geocoder
+            knows it, or None if the place can't be found
+
+        Returns
+        -------
+        dict
+            {'lat', 'lng'} coordinates, or None if the place can't be found
+
+        """
+        location = self.lookup(query)
+        if location is not None:
+            return location
+        with self._lock:
+            self.remote_lookups += 1
+        location = fallback(query)
+        if location is None:
+            return None
+        self.add(query, location, location.get('name'))
+        return {'lat' : location['lat'], 'lng' : location['lng']}
+
+    def prefix(self, text, limit=10):
+        """List indexed places whose normalized query starts with some text
+
+        Parameters
+        ----------
+        text : str
+            partial place name query
+        limit : int, optional
+            maximum number of places to return. The default is 10.
+
+        Returns
+        -------
+        list
+            list of {'name', 'lat', 'lng'} dicts, in alphabetical order of
+            their queries. Entries without a name are skipped
+
+        """
+        key = self.normalize(text)
+        if not key:
+            return []
+        self._sync()
+        out = []
+        names = set()
+        with self._lock:
+            self._expire()
+            ii = bisect.bisect_left(self._keys, key)
+            while ii < len(self._keys) and len(out) < limit and self._keys[ii].startswith(key):
+                entry = self.entries[self._keys[ii]]
+                if entry['name'] and entry['name'] not in names and not self._expired(entry):
+                    names.add(entry['name'])
+                    out.append({'name' : entry['name'], 'lat' : entry['lat'], 'lng' : entry['lng']})
+                ii += 1
+        return out
+
+    def load_seed(self, seed_filename):
+        """Add places from an offline place-name CSV file
+
+        The file should have a header row with 'name', 'lat' (or
+        'latitude'), and 'lng' (or 'lon' or 'longitude') columns. Seeded
+        places are not copied to filename.
+
+        Parameters
+        ----------
+        seed_filename : str
+            CSV file of place names and coordinates
+
+        Returns
+        -------
+        int
+            number of places added
+
+        """
+        count = 0
+        with open(seed_filename, 'r', newline='') as fp:
+            for row in csv.DictReader(fp):
+                row = {key.strip().lower() : value for key, value in row.items() if key}
+                lat = row.get('lat', row.get('latitude'))
+                lng = row.get('lng', row.get('lon', row.get('longitude')))
+                if not row.get('name') or not lat or not lng:
+                    continue
+                self.add(row['name'], {'lat' : lat, 'lng' : lng}, row['name'].strip(), persist=False, seeded=True)
+                count += 1
+        return count
+
+    def stats(self):
+        """Summarize the index size and hit rate
+
+        Returns
+        -------
+        dict
+            number of entries, hits, misses, remote lookups, evictions, and
+            hit rate
+
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries' : len(self.entries),
+                'hits' : self.hits,
+                'misses' : self.misses,
+                'remote_lookups' : self.remote_lookups,
+                'evicted' : self.evicted,
+                'hit_rate' : float(self.hits) / lookups if lookups else 0.0
+                    }
+
+    def _insert(self, entry):
+        """Add an entry to the in-memory index. Call with _lock held"""
+        old = self.entries.get(entry['query'])
+        if self._expired(entry) or (old is not None and old['time'] is None and entry['time'] is not None):
+            # Seeded places take precedence over Google's answers
+            return
+        if old is None:
+            bisect.insort(self._keys, entry['query'])
+        self.entries[entry['query']] = entry
+        self._remote.pop(entry['query'], None)
+        if entry['time'] is not None:
+            self._remote[entry['query']] = entry['time']
+            self._expire()
+
+    def _remove(self, key):
+        """Drop an entry from the in-memory index. Call with _lock held"""
+        del self.entries[key]
+        del self._keys[bisect.bisect_left(self._keys, key)]
+        self._remote.pop(key, None)
+        self.evicted += 1
+
+    def _expired(self, entry):
+        """Whether an entry from Google is older than max_age"""
+        return entry['time'] is not None and entry['time'] < time.time() - self.max_age
+
+    def _expire(self):
+        """Drop expired and excess entries from Google. Call with _lock held"""
+        oldest = time.time() - self.max_age
+        while self._remote:
+            key, added = next(iter(self._remote.items()))
+            if added >= oldest and len(self._remote) <= self.max_entries:
+                break
+            self._remove(key)
+
+    def _sync(self):
+        """Read entries appended to filename since it was last read"""
+        if not self.filename or not os.path.isfile(self.filename):
+            return
+        with self._lock:
+            with open(self.filename, 'r') as fp:
+                header = fp.readline()
+                if header != self._file_header:
+                    # New, or rewritten by another worker's _compact
+                    self._file_header = header if header.endswith('\n') else None
+                    self._file_offset = 0
+                    self._file_lines = 0
+                if os.fstat(fp.fileno()).st_size <= self._file_offset:
+                    return
+                fp.seek(self._file_offset)
+                for line in iter(fp.readline, ''):
+                    if not line.endswith('\n'):
+                        # A write in progress; read it next time
+                        break
+                    self._file_offset = fp.tell()
+                    self._file_lines += 1
+                    try:
+                        entry = json.loads(line)
+                        # Entries without a time predate expiry, and expire now
+                        self._insert({'query' : entry['query'], 'name' : entry.get('name'),
+                                      'lat' : float(entry['lat']), 'lng' : float(entry['lng']),
+                                      'time' : float(entry.get('time', 0))})
+                    except (ValueError, KeyError, TypeError):
+                        continue
+            if self._file_lines > 2*max(self.max_entries, 1):
+                self._compact()
+
+    def _compact(self):
+        """Rewrite filename with only the live entries. Call with _lock held
+
+        Entries other workers append while the file is rewritten may be
+        lost, which only costs them a remote lookup.
+        """
+        temp_filename = '{}.{}.tmp'.format(self.filename, os.getpid())
+        # A unique first line tells other workers the file was rewritten
+        header = json.dumps({'compacted' : time.time(), 'pid' : os.getpid()}) + '\n'
+        with open(temp_filename, 'w') as fp:
+            fp.write(header)
+            for key in self._remote:
+                fp.write(json.dumps(self.entries[key]) + '\n')
+            size = fp.tell()
+        os.replace(temp_filename, self.filename)
+        self._file_header = header
+        self._file_offset = size
+        self._file_lines = len(self._remote) + 1
@@ -10,8 +10,11 @@ API.
 """
 
 #..Use the Google Places API to extract reviews and photos from map locations..
+from concurrent.futures import ThreadPoolExecutor, wait
+from deadline import DeadlineExceeded
 import requests
 import json
+import math
 import os
 
 class GooglePlaces(object):
@@ -27,6 +30,14 @@ class GooglePlaces(object):
         search radius to use for location-based queries
     apiKey : str
         Google Cloud API key with access to Google Places
+    DEFAULT_TIMEOUT : float
+        per-call timeout in seconds to use as a default if not supplied to init
+    request_timeout : float
+        maximum time, in seconds, to wait on any single Google API call
+    DEFAULT_WORKERS : int
+        default number of concurrent Google Places Details calls
+    DEFAULT_SEARCH_WORKERS : int
+        default number of concurrent Google Places searches
         
     Methods
     -------
@@ -50,7 +61,7 @@ class GooglePlaces(object):
         Find just photos for a location given a Google PlaceID
     retrieve_reviews(self, query, location=()):
         Retrieve Google Places reviews given text query and optional coords
-    retrieve_reviews_multi(self, query, location=()):
+    retrieve_reviews_multi(self, query, location=(), deadline=None, max_results=None, text_queries=(), max_calls=None):
         Retrieve Google Places reviews for multiple locations
     retrieve_photo(self, photo_element):
         Given a Google photo element, returns the url for photo retrieval
@@ -62,8 +73,13 @@ class GooglePlaces(object):
     
     search_filename = "search_path.txt"
     DEFAULT_RADIUS = 500 #Default search radius, in meters
+    DEFAULT_TIMEOUT = 10 #Default per-call timeout, in seconds
+    DEFAULT_WORKERS = 24 #Default number of concurrent Details calls
+    DEFAULT_SEARCH_WORKERS = 8 #Default number of concurrent searches
+    EARTH_RADIUS = 6371000 #Mean radius of the Earth, in meters
     
-    def __init__(self, apiKey, search_radius=DEFAULT_RADIUS):
+    def __init__(self, apiKey, search_radius=DEFAULT_RADIUS, request_timeout=DEFAULT_TIMEOUT, max_workers=DEFAULT_WORKERS,
+                 search_workers=DEFAULT_SEARCH_WORKERS):
         """
         Parameters
         ----------
@@ -72,6 +88,17 @@ class GooglePlaces(object):
         search_radius : float, optional
             radius within which to conduct location-based searches. The 
             default is DEFAULT_RADIUS.
+        request_timeout : float, optional
+            maximum time, in seconds, to wait on any single Google API call.
+            The default is DEFAULT_TIMEOUT.
+        max_workers : int, optional
+            maximum number of concurrent Google Places Details calls, shared
+            by all requests. The default is DEFAULT_WORKERS, enough for all
+            of the Details calls of one /multipark request at once.
+        search_workers : int, optional
+            maximum number of concurrent Google Places searches, shared by
+            all requests. Searches have their own threads so that they never
+            wait behind Details calls. The default is DEFAULT_SEARCH_WORKERS.
 
         Returns
         -------
@@ -82,8 +109,48 @@ class GooglePlaces(object):
         super(GooglePlaces, self).__init__()
         self.search_radius = search_radius
         self.apiKey = apiKey
+        self.request_timeout = request_timeout
+        # Threads are started on first use, so this is safe to create before
+        # gunicorn forks its workers
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.search_executor = ThreadPoolExecutor(max_workers=search_workers)
+    
+    def _get(self, endpoint_url, params, deadline=None):
+        """Send a GET request to a Google API endpoint within a time budget
+
+        Parameters
+        ----------
+        endpoint_url : str
+            Google API endpoint
+        params : dict
+            request parameters
+        deadline : deadline.Deadline, optional
+            time budget for the request. The default is no budget beyond
+            request_timeout.
+
+        Raises
+        ------
+        DeadlineExceeded
+            if the deadline runs out before or during the request
+
+        Returns
+        -------
+        res : requests.Response
+            the response
+
+        """
         
-    def place_id_by_coordinate(self, query, location, radius=()):
+        if deadline is None:
+            return requests.get(endpoint_url, params=params, timeout=self.request_timeout)
+        try:
+            return requests.get(endpoint_url, params=params, timeout=deadline.timeout(self.request_timeout))
+        except requests.exceptions.Timeout:
+            if deadline.expired():
+                deadline.mark_partial()
+                raise DeadlineExceeded("Request deadline of {} s exceeded".format(deadline.budget))
+            raise
+        
+    def place_id_by_coordinate(self, query, location, radius=(), deadline=None):
         """Find a Google PlaceID given a text search query and coordinates
 
         Parameters
@@ -94,6 +161,9 @@ class GooglePlaces(object):
             a two-index lat/lon list or tuple
         radius : float, optional
             search radius, in meters, within which to search.
+        deadline : deadline.Deadline, optional
+            time budget for the request. The default is no budget beyond
+            request_timeout.
 
         Returns
         -------
@@ -111,17 +181,20 @@ class GooglePlaces(object):
                 'locationbias' : 'circle:{}@{},{}'.format(radius,location[0],location[1]),
                 'key' : self.apiKey
                 }
-        res = requests.get(endpoint_url,params = params)
+        res = self._get(endpoint_url, params, deadline)
         results = json.loads(res.content)
         return results
     
-    def place_id_by_textquery(self, query):
+    def place_id_by_textquery(self, query, deadline=None):
         """Find a Google PlaceID given just a text search query
 
         Parameters
         ----------
         query : str
             search query. e.g. keywords describing a park
+        deadline : deadline.Deadline, optional
+            time budget for the request. The default is no budget beyond
+            request_timeout.
 
         Returns
         -------
@@ -136,22 +209,25 @@ class GooglePlaces(object):
                 'inputtype' : 'textquery',
                 'key' : self.apiKey
                 }
-        res = requests.get(endpoint_url,params = params)
+        res = self._get(endpoint_url, params, deadline)
         results = json.loads(res.content)
         return results
     
-    def place_coordinate_by_textquery(self, query):
+    def place_coordinate_by_textquery(self, query, deadline=None):
         """Find location coordinates given just a text search query
 
         Parameters
         ----------
         query : str
             search query. e.g. keywords describing a park
+        deadline : deadline.Deadline, optional
+            time budget for the request. The default is no budget beyond
+            request_timeout.
 
         Returns
         -------
         results : JSON dict
-            JSON dict of Google Places geometry output
+            JSON dict of Google Places geometry and name output
 
         """
         
@@ -159,14 +235,14 @@ class GooglePlaces(object):
         params = {
                 'input' : query,
                 'inputtype' : 'textquery',
-                'fields' : 'geometry',
+                'fields' : 'geometry,name',
                 'key' : self.apiKey
                 }
-        res = requests.get(endpoint_url,params = params)
+        res = self._get(endpoint_url, params, deadline)
         results = json.loads(res.content)
         return results
     
-    def places_by_coordinate(self, typ, location, radius=()):
+    def places_by_coordinate(self, typ, location, radius=(), deadline=None):
         """Find multiple Google PlaceIDs given a location type and coordinates
 
         Parameters
@@ -178,6 +254,9 @@ class GooglePlaces(object):
             a two-index lat/lon list or tuple
         radius : float, optional
             search radius, in meters, within which to search.
+        deadline : deadline.Deadline, optional
+            time budget for the request. The default is no budget beyond
+            request_timeout.
 
         Returns
         -------
@@ -195,11 +274,11 @@ class GooglePlaces(object):
                 'radius' : radius,
                 'key' : self.apiKey
                 }
-        res = requests.get(endpoint_url,params = params)
+        res = self._get(endpoint_url, params, deadline)
         results = json.loads(res.content)
         return results
     
-    def places_by_textquery(self, query, location, radius=()):
+    def places_by_textquery(self, query, location, radius=(), deadline=None):
         """Find multiple Google PlaceIDs given a text query and coordinates
 
         Parameters
@@ -210,6 +289,9 @@ class GooglePlaces(object):
             a two-index lat/lon list or tuple
         radius : float, optional
             search radius, in meters, within which to search.
+        deadline : deadline.Deadline, optional
+            time budget for the request. The default is no budget beyond
+            request_timeout.
 
         Returns
         -------
@@ -219,25 +301,27 @@ class GooglePlaces(object):
         """
         if not radius:
             radius = self.search_radius
-        endpoint_url = "https://maps.googleapis.com/maps/api/place/findplacefromtext/json"
+        endpoint_url = "https://maps.googleapis.com/maps/api/place/textsearch/json"
         params = {
                 'query' : query,
-                'inputtype' : 'textquery',
-                'location' : '{},{}'.format(radius,location[0],location[1]),
+                'location' : '{},{}'.format(location[0],location[1]),
                 'radius' : radius,
                 'key' : self.apiKey
                 }
-        res = requests.get(endpoint_url,params = params)
+        res = self._get(endpoint_url, params, deadline)
         results = json.loads(res.content)
         return results
     
-    def place_details(self, place_id):
+    def place_details(self, place_id, deadline=None):
         """Find Google Place Details given a PlaceID
 
         Parameters
         ----------
         place_id : str
             Google PlaceID for the desired location
+        deadline : deadline.Deadline, optional
+            time budget for the request. The default is no budget beyond
+            request_timeout.
 
         Returns
         -------
@@ -252,17 +336,20 @@ class GooglePlaces(object):
                 'fields' : ",".join(['photo','formatted_address','name']),
                 'key' : self.apiKey
                 }
-        res = requests.get(endpoint_url,params = params)
+        res = self._get(endpoint_url, params, deadline)
         results = json.loads(res.content)
         return results
     
-    def place_reviews(self, place_id):
+    def place_reviews(self, place_id, deadline=None):
         """Find Google Place Reviews given a PlaceID
 
         Parameters
         ----------
         place_id : str
             Google PlaceID for the desired location
+        deadline : deadline.Deadline, optional
+            time budget for the request. The default is no budget beyond
+            request_timeout.
 
         Returns
         -------
@@ -279,7 +366,7 @@ class GooglePlaces(object):
                 'fields' : ",".join(['geometry','review','formatted_address','name','place_id','type']),
                 'key' : self.apiKey
                 }
-        res = requests.get(endpoint_url,params = params)
+        res = self._get(endpoint_url, params, deadline)
         results = json.loads(res.content)
         return results
     
@@ -303,7 +390,7 @@ class GooglePlaces(object):
                 'fields' : 'photo',
                 'key' : self.apiKey
                 }
-        res = requests.get(endpoint_url,params = params)
+        res = self._get(endpoint_url, params)
         results = json.loads(res.content)['result']['photos']
         return results
     
@@ -336,35 +423,147 @@ class GooglePlaces(object):
             reviews = json.loads(find_fail_text)
         return reviews
     
-    def retrieve_reviews_multi(self, query, location=()):
+    def retrieve_reviews_multi(self, query, location=(), deadline=None, max_results=None, text_queries=(), max_calls=None):
         """Retrieve Google Places reviews for multiple locations
         
-        Contains a request for many PlaceIDs and uses them to request reviews
+        Runs one location search per place type and per text query
+        concurrently, merges their results by PlaceID, and requests reviews
+        for the merged locations concurrently. Text search results farther
+        than search_radius from location are dropped, as Text Search only
+        biases toward it. Locations found by more searches are requested
+        first. Each review result is given a
+        'search_provenance' list naming the searches that found it, e.g.
+        ['type:park', 'text:playground'].
+        
+        If a deadline is given, searches and reviews that are not ready when
+        it runs out are dropped and the deadline is marked partial, and an
+        empty list is returned if no locations are found.
 
         Parameters
         ----------
-        query : str
-            text search query to find a location
+        query : list or str
+            list of Google place types to search for, or a single text search
+            query
         location : [float, float], optional
             lat/lon list or tuple of float location coordinates
+        deadline : deadline.Deadline, optional
+            time budget for all of the requests
+        max_results : int, optional
+            maximum number of locations for which to request reviews. The
+            default is all of the merged search results.
+        text_queries : list, optional
+            additional text search queries to run alongside query
+        max_calls : int, optional
+            maximum total number of Google API calls (searches plus review
+            requests). The default is no limit.
 
         Returns
         -------
         reviews : list
-            list of JSON dicts containing all of the reviews for multiple locs
+            list of JSON dicts containing all of the reviews for multiple locs.
+            Without a deadline, a single placeholder result with types
+            ['Query Not Found'] if no locations are found
             
         """
 
         find_fail_text = '{"html_attributions": [], "result": {"formatted_address": "nan", "geometry" : {"location" : "", "viewport": "nan"},"name": "nan", "place_id": "nan","types": ["Query Not Found"]}}'
         if isinstance(query,list):
-            candidates = self.places_by_coordinate(query[0],location,self.search_radius)
-        else:
-            candidates = self.places_by_textquery(query,location,self.search_radius)
-        if candidates['results']:
-            reviews = [self.place_reviews(candidates['results'][ii]['place_id']) for ii in range(len(candidates['results']))]
+            searches = [('type', typ) for typ in query]
         else:
-            reviews = [json.loads(find_fail_text)]
+            searches = [('text', query)]
+        searches += [('text', text) for text in text_queries if ('text', text) not in searches]
+        if max_calls is not None:
+            searches = searches[:max_calls]
+        
+        # Run all of the searches at once
+        search_futures = []
+        for kind, term in searches:
+            if kind == 'type':
+                search_futures.append(self.search_executor.submit(self.places_by_coordinate,term,location,self.search_radius,deadline))
+            else:
+                search_futures.append(self.search_executor.submit(self.places_by_textquery,term,location,self.search_radius,deadline))
+        
+        # Merge the search results by PlaceID, keeping track of which searches
+        # found each location
+        place_ids = []
+        provenance = {}
+        for (kind, term), candidates in zip(searches, self._collect(search_futures, deadline)):
+            if candidates is None:
+                continue
+            for result in candidates.get('results', []):
+                # Text Search only biases its results toward the location, so
+                # drop places outside the search radius
+                if kind == 'text' and location and not self._within_radius(result, location):
+                    continue
+                if result['place_id'] not in provenance:
+                    place_ids.append(result['place_id'])
+                    provenance[result['place_id']] = []
+                provenance[result['place_id']].append('{}:{}'.format(kind, term))
+        if not place_ids:
+            if deadline is not None:
+                return []
+            return [json.loads(find_fail_text)]
+        
+        # Request reviews for the locations found by the most searches first,
+        # within the call limits
+        place_ids = sorted(place_ids, key=lambda place_id: -len(provenance[place_id]))
+        if max_calls is not None:
+            place_ids = place_ids[:max(0, max_calls - len(searches))]
+        place_ids = place_ids[:max_results]
+        review_futures = [self.executor.submit(self.place_reviews,place_id,deadline) for place_id in place_ids]
+        reviews = []
+        for place_id, review in zip(place_ids, self._collect(review_futures, deadline)):
+            if review is not None:
+                review['result']['search_provenance'] = provenance[place_id]
+                reviews.append(review)
         return reviews
+    
+    def _within_radius(self, result, location):
+        """Whether a search result lies within search_radius of location
+
+        Results without coordinates are kept.
+        """
+        try:
+            place = result['geometry']['location']
+            lat1, lng1 = math.radians(location[0]), math.radians(location[1])
+            lat2, lng2 = math.radians(float(place['lat'])), math.radians(float(place['lng']))
+        except (KeyError, TypeError, ValueError):
+            return True
+        hav = math.sin((lat2-lat1)/2)**2 + math.cos(lat1)*math.cos(lat2)*math.sin((lng2-lng1)/2)**2
+        return 2*self.EARTH_RADIUS*math.asin(min(1.0,math.sqrt(hav))) <= self.search_radius
+    
+    def _collect(self, futures, deadline=None):
+        """Wait for concurrent Google API calls, up to an optional deadline
+
+        Parameters
+        ----------
+        futures : list
+            list of concurrent.futures.Future objects
+        deadline : deadline.Deadline, optional
+            time budget. Calls that are not done or fail by the deadline are
+            replaced by None and the deadline is marked partial. Without a
+            deadline, failures are raised.
+
+        Returns
+        -------
+        list
+            the results of the calls, in order, with None for dropped calls
+
+        """
+        
+        done, not_done = wait(futures, timeout=deadline.remaining() if deadline else None)
+        for future in not_done:
+            future.cancel()
+        results = []
+        for future in futures:
+            if future in done and future.exception() is None:
+                results.append(future.result())
+            elif deadline is not None:
+                deadline.mark_partial()
+                results.append(None)
+            else:
+                raise future.exception()
+        return results
         
     
     def retrieve_photo(self, photo_element):
@@ -387,7 +586,7 @@ class GooglePlaces(object):
                 'maxwidth' : photo_element['width'],
                 'key' : self.apiKey
                 }
-        res = requests.get(endpoint_url,params = params)
+        res = self._get(endpoint_url, params)
         return res.url
     
     def retrieve_photo_url_from_location(self,query,location):
@@ -0,0 +1,326 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+.................Versioned model registry for PLAYGROUNDr web app...............
+Author: James Bramante
+Date: February 10, 2020
+
+This module contains the ModelRegistry class, which loads the pickled
+classifier and TF-IDF vectorizer from versioned model directories and swaps
+in new versions without restarting the web server.
+
+Models are stored one version per directory:
+
+    data/models/<version>/classifier.mod
+    data/models/<version>/TFIDFmodel.mod
+    data/models/CURRENT     (text file naming the active version)
+
+If there is no CURRENT file, the version whose directory name sorts last is
+used. If there is no models directory at all, the legacy data/classifier.mod
+and data/TFIDFmodel.mod files are loaded as version "legacy".
+"""
+
+from collections import namedtuple
+import os
+import pickle
+import shutil
+import tempfile
+import threading
+import time
+
+# A complete, immutable set of models. Requests take one ModelSet reference at
+# the start and use it throughout, so a swap never mixes model versions
+ModelSet = namedtuple('ModelSet', ['version', 'clf', 'tfidf_model'])
+
+class ModelRegistry(object):
+    """Loads versioned model files and atomically swaps in new versions
+
+    Attributes
+    ----------
+    classifier_filename : str
+        filename of the pickled list of classifiers within a version directory
+    vectorizer_filename : str
+        filename of the pickled TF-IDF vectorizer within a version directory
+    current_filename : str
+        filename, within model_dir, of the file naming the active version
+    DEFAULT_POLL_INTERVAL : float
+        seconds between checks for a new model version, if not supplied
+    model_dir : str
+        directory containing one subdirectory per model version
+    legacy_files : (str, str)
+        classifier and vectorizer filenames to use if model_dir is missing
+    poll_interval : float
+        seconds between checks for a new model version. 0 disables polling
+
+    Methods
+    -------
+    preload(self):
+        Load the active ModelSet without starting the background poller
+    current(self):
+        Return the active ModelSet, loading it first if necessary
+    refresh(self):
+        Load and swap in the target model version if it has changed
+    start(self):
+        Start the background thread that polls for new model versions
+    stop(self):
+        Stop the background polling thread
+    versions(self):
+        List the model versions available in model_dir
+    publish(self, clf, tfidf_model, version=None, activate=True):
+        Write a new model version to model_dir and optionally activate it
+    """
+
+    classifier_filename = "classifier.mod"
+    vectorizer_filename = "TFIDFmodel.mod"
+    current_filename = "CURRENT"
+    LEGACY_VERSION = "legacy"
+    DEFAULT_POLL_INTERVAL = 30 #Seconds between checks for new model versions
+
+    def __init__(self, model_dir, legacy_files=(), poll_interval=DEFAULT_POLL_INTERVAL):
+        """
+        Parameters
+        ----------
+        model_dir : str
+            directory containing one subdirectory per model version
+        legacy_files : (str, str), optional
+            classifier and vectorizer filenames to load if model_dir does not
+            contain any versions
+        poll_interval : float, optional
+            seconds between checks for a new model version. The default is
+            DEFAULT_POLL_INTERVAL. 0 disables background polling.
+
+        Returns
+        -------
+        None.
+
+        """
+
+        super(ModelRegistry, self).__init__()
+        self.model_dir = model_dir
+        self.legacy_files = legacy_files
+        self.poll_interval = poll_interval
+        self._models = None
+        self._load_lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._poller = None
+        self._poller_pid = None
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._after_fork)
+
+    def preload(self):
+        """Load the active ModelSet without starting the background poller
+
+        Call this at import time, e.g. so that gunicorn --preload loads the
+        models once in the master process. The poller is started by the first
+        call to current() in each process that serves requests.
+
+        Returns
+        -------
+        ModelSet
+            the active model version, classifier list, and vectorizer
+
+        """
+
+        models = self._models
+        if models is None:
+            with self._load_lock:
+                if self._models is None:
+                    self._models = self._load(self._target_version())
+                models = self._models
+        return models
+
+    def current(self):
+        """Return the active ModelSet, loading it first if necessary
+
+        Callers should call this once per request and hold on to the returned
+        ModelSet, rather than calling it again part-way through a request.
+        The first call in a process also starts the background poller.
+
+        Returns
+        -------
+        ModelSet
+            the active model version, classifier list, and vectorizer
+
+        """
+
+        # Forked gunicorn workers do not inherit the parent's threads
+        if self.poll_interval and self._poller_pid != os.getpid():
+            self.start()
+        return self.preload()
+
+    def refresh(self):
+        """Load and swap in the target model version if it has changed
+
+        The new models are fully loaded before the swap, which replaces a
+        single reference, so requests in flight keep the ModelSet they began
+        with.
+
+        Returns
+        -------
+        bool
+            True if a new model version was swapped in
+
+        """
+
+        version = self._target_version()
+        if self._models is not None and self._models.version == version:
+            return False
+        with self._load_lock:
+            if self._models is not None and self._models.version == version:
+                return False
+            models = self._load(version)
+            self._models = models
+        return True
+
+    def start(self):
+        """Start the background thread that polls for new model versions
+
+        Returns
+        -------
+        None.
+
+        """
+
+        if self._poller_pid == os.getpid() and self._poller is not None and self._poller.is_alive():
+            return
+        self._stop_event.clear()
+        self._poller = threading.Thread(target=self._poll, name='ModelRegistryPoller')
+        self._poller.daemon = True
+        self._poller_pid = os.getpid()
+        self._poller.start()
+
+    def stop(self):
+        """Stop the background polling thread
+
+        Returns
+        -------
+        None.
+
+        """
+
+        self._stop_event.set()
+        if self._poller is not None and self._poller_pid == os.getpid():
+            self._poller.join()
+        self._poller = None
+        self._poller_pid = None
+
+    def versions(self):
+        """List the model versions available in model_dir
+
+        Returns
+        -------
+        list
+            sorted list of version directory names containing both model files
+
+        """
+
+        if not os.path.isdir(self.model_dir):
+            return []
+        return sorted([name for name in os.listdir(self.model_dir)
+                       if not name.startswith('.')
+                       and os.path.isfile(os.path.join(self.model_dir,name,self.classifier_filename))
+                       and os.path.isfile(os.path.join(self.model_dir,name,self.vectorizer_filename))])
+
+    def publish(self, clf, tfidf_model, version=None, activate=True):
+        """Write a new model version to model_dir and optionally activate it
+
+        The version directory is written under a temporary name and renamed
+        into place, and CURRENT is replaced atomically, so pollers never see a
+        half-written version.
+
+        Parameters
+        ----------
+        clf : list
+            list of fitted per-amenity classifiers
+        tfidf_model : sklearn.TfidfVectorizer
+            fitted vectorizer feeding the classifiers
+        version : str, optional
+            name of the new version. The default is a UTC timestamp.
+        activate : bool, optional
+            whether to point CURRENT at the new version. The default is True.
+
+        Returns
+        -------
+        version : str
+            name of the published version
+
+        """
+
+        if not version:
+            version = time.strftime('%Y%m%dT%H%M%SZ', time.gmtime())
+        os.makedirs(self.model_dir, exist_ok=True)
+        version_dir = os.path.join(self.model_dir, version)
+        if os.path.exists(version_dir):
+            raise ValueError("Model version {} already exists".format(version))
+        temp_dir = tempfile.mkdtemp(prefix='.' + version, dir=self.model_dir)
+        try:
+            with open(os.path.join(temp_dir,self.classifier_filename),'wb') as fp:
+                pickle.dump(clf, fp)
+            with open(os.path.join(temp_dir,self.vectorizer_filename),'wb') as fp:
+                pickle.dump(tfidf_model, fp)
+            # mkdtemp creates the directory readable only by its owner. Open
+            # it up as makedirs would, so that servers running as another
+            # user (e.g. models published by a CI trainer) can read it
+            umask = os.umask(0)
+            os.umask(umask)
+            os.chmod(temp_dir, 0o777 & ~umask)
+            os.rename(temp_dir, version_dir)
+        except BaseException:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+            raise
+        if activate:
+            current_file = os.path.join(self.model_dir,self.current_filename)
+            with open(current_file + '.tmp','w') as fp:
+                fp.write(version + '\n')
+            os.replace(current_file + '.tmp', current_file)
+        return version
+
+    def _target_version(self):
+        """Determine which model version should be active"""
+
+        current_file = os.path.join(self.model_dir,self.current_filename)
+        if os.path.isfile(current_file):
+            with open(current_file,'r') as fp:
+                version = fp.readline().strip()
+            if version:
+                return version
+        versions = self.versions()
+        if versions:
+            return versions[-1]
+        return self.LEGACY_VERSION
+
+    def _load(self, version):
+        """Unpickle the models for a version into a new ModelSet"""
+
+        if version == self.LEGACY_VERSION and self.legacy_files:
+            classifier_file, vectorizer_file = self.legacy_files
+        else:
+            classifier_file = os.path.join(self.model_dir,version,self.classifier_filename)
+            vectorizer_file = os.path.join(self.model_dir,version,self.vectorizer_filename)
+        with open(classifier_file,'rb') as fp:
+            clf = pickle.load(fp)
+        with open(vectorizer_file,'rb') as fp:
+            tfidf_model = pickle.load(fp)
+        return ModelSet(version, clf, tfidf_model)
+
+    def _poll(self):
+        """Background loop that refreshes the models every poll_interval"""
+
+        while not self._stop_event.wait(self.poll_interval):
+            try:
+                self.refresh()
+            except Exception as err:
+                # Keep serving the current models if a new version is broken
+                print("ModelRegistry: failed to load new model version: {}".format(err))
+
+    def _after_fork(self):
+        """Reset locks and poller state in a forked child process
+
+        A lock held by another thread at fork time would stay locked forever
+        in the child, so the child gets fresh ones.
+        """
+
+        self._load_lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._poller = None
+        self._poller_pid = None
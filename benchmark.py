@@ -0,0 +1,303 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+...................Model serving-cost benchmark for PLAYGROUNDr.................
+Author: James Bramante
+Date: February 12, 2020
+
+This script compares candidate featurizer + classifier pairs on a held-out
+labeled review set. Alongside accuracy and F-beta (beta=0.5, as used in
+PLAYGROUNDr_model_training.ipynb) it reports what each candidate costs to
+serve: per-document vectorize and scoring latency, batch throughput, model
+file size, load time, and resident memory.
+
+Each candidate is loaded and measured in a fresh process, so load time and
+memory are measured cold and are not polluted by previously loaded
+candidates. Per-document latency uses the same call pattern as
+util.process_review (one document vectorized and scored at a time).
+
+Candidates are given as KIND:FEATURIZER:CLASSIFIER, where FEATURIZER and
+CLASSIFIER are model files and KIND is one of
+    tfidf : a pickled vectorizer with a transform method (e.g. the app's
+            TFIDFmodel.mod, or a TF-IDF + TruncatedSVD pipeline)
+    bow   : a pickled word2index dict (or (index2word, word2index) tuple)
+    w2v   : gensim KeyedVectors saved with KeyedVectors.save
+and CLASSIFIER is a pickled list of one classifier per amenity, like the
+app's classifier.mod. For example:
+
+    python benchmark.py heldout.json tfidf:data/TFIDFmodel.mod:data/classifier.mod
+
+This script requires numpy, scikit-learn, psutil, and the util module (and
+gensim for w2v candidates).
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import argparse
+import json
+import os
+import pickle
+import time
+import numpy as np
+from diagnostics import rss_bytes
+import util
+
+featurizer_kinds = ['tfidf', 'bow', 'w2v'] # Supported featurizer types
+fbeta = 0.5 # Beta for the F-beta score, favoring precision as in training
+
+def load_featurizer(kind, featurizer_file):
+    """Loads a featurizer model file of the given kind
+
+    Parameters
+    ----------
+    kind : str
+        one of featurizer_kinds
+    featurizer_file : str
+        filename of the featurizer model
+
+    Returns
+    -------
+    object
+        the loaded featurizer
+
+    """
+    if kind == 'w2v':
+        from gensim.models import KeyedVectors
+        return KeyedVectors.load(featurizer_file)
+    with open(featurizer_file,'rb') as fp:
+        featurizer = pickle.load(fp)
+    if kind == 'bow' and isinstance(featurizer,tuple):
+        featurizer = featurizer[1]
+    return featurizer
+
+def vectorize(kind, words, featurizer):
+    """Vectorizes a single cleaned review document the way the app would
+
+    Parameters
+    ----------
+    kind : str
+        one of featurizer_kinds
+    words : str
+        a cleaned review document (output of util.text_prepare)
+    featurizer : object
+        featurizer returned by load_featurizer
+
+    Returns
+    -------
+    array-like
+        a 1 x N feature array (sparse for tfidf)
+
+    """
+    if kind == 'tfidf':
+        return util.tfidf_vectorize(words,featurizer)
+    elif kind == 'bow':
+        vect = util.bag_of_words_vectorize(words,featurizer)
+        # As in training, normalize counts by document length
+        return vect / max(len(words.split()),1)
+    else:
+        return util.w2v_vectorize(words,featurizer)
+
+def vectorize_batch(kind, documents, featurizer):
+    """Vectorizes a list of cleaned review documents in one call
+
+    Parameters
+    ----------
+    kind : str
+        one of featurizer_kinds
+    documents : list
+        cleaned review documents
+    featurizer : object
+        featurizer returned by load_featurizer
+
+    Returns
+    -------
+    array-like
+        a len(documents) x N feature array
+
+    """
+    if kind == 'tfidf':
+        return featurizer.transform(documents)
+    return np.vstack([vectorize(kind,doc,featurizer) for doc in documents])
+
+def benchmark_candidate(kind, featurizer_file, classifier_file, documents, y, repeats=3):
+    """Measures accuracy and serving cost for one featurizer + classifier pair
+
+    Intended to run in a fresh process (see run_benchmarks).
+
+    Parameters
+    ----------
+    kind : str
+        one of featurizer_kinds
+    featurizer_file : str
+        filename of the featurizer model
+    classifier_file : str
+        filename of the pickled list of per-amenity classifiers
+    documents : list
+        cleaned held-out review documents
+    y : numpy.array
+        len(documents) x num classifiers array of amenity labels
+    repeats : int, optional
+        number of timed passes for batch throughput. The default is 3.
+
+    Returns
+    -------
+    result : dict
+        accuracy and cost metrics for the candidate
+
+    """
+    from sklearn import metrics
+
+    # Load the models cold and measure what they cost to hold in memory
+    rss_before = rss_bytes()
+    start = time.perf_counter()
+    featurizer = load_featurizer(kind,featurizer_file)
+    featurizer_load_s = time.perf_counter() - start
+    start = time.perf_counter()
+    with open(classifier_file,'rb') as fp:
+        clf = pickle.load(fp)
+    classifier_load_s = time.perf_counter() - start
+    rss_after = rss_bytes()
+
+    # Per-document latency, following the util.process_review call pattern.
+    # score_ms covers the classifiers alone; total_ms includes vectorizing
+    vectorize_ms = []
+    score_ms = []
+    total_ms = []
+    for doc in documents:
+        start = time.perf_counter()
+        X_vect = vectorize(kind,doc,featurizer)
+        vectorized = time.perf_counter()
+        [clf[ii].predict(X_vect[0:1,:])[0] for ii in range(len(clf))]
+        scored = time.perf_counter()
+        vectorize_ms.append((vectorized - start)*1000)
+        score_ms.append((scored - vectorized)*1000)
+        total_ms.append((scored - start)*1000)
+
+    # Batch throughput: vectorize and score all documents at once
+    batch_s = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        X_vect = vectorize_batch(kind,documents,featurizer)
+        y_pred = np.array([clf[ii].predict(X_vect) for ii in range(len(clf))]).T
+        batch_s.append(time.perf_counter() - start)
+
+    # Accuracy per amenity
+    accuracy = [float(metrics.accuracy_score(y[:,ii],y_pred[:,ii])) for ii in range(y_pred.shape[1])]
+    fscore = [float(metrics.fbeta_score(y[:,ii],y_pred[:,ii],beta=fbeta)) for ii in range(y_pred.shape[1])]
+
+    result = {
+        'kind' : kind,
+        'featurizer' : featurizer_file,
+        'classifier' : classifier_file,
+        'accuracy' : accuracy,
+        'fbeta' : fscore,
+        'mean_accuracy' : float(np.mean(accuracy)),
+        'mean_fbeta' : float(np.mean(fscore)),
+        'vectorize_ms_mean' : float(np.mean(vectorize_ms)),
+        'vectorize_ms_p50' : float(np.percentile(vectorize_ms,50)),
+        'vectorize_ms_p95' : float(np.percentile(vectorize_ms,95)),
+        'score_ms_mean' : float(np.mean(score_ms)),
+        'score_ms_p50' : float(np.percentile(score_ms,50)),
+        'score_ms_p95' : float(np.percentile(score_ms,95)),
+        'total_ms_mean' : float(np.mean(total_ms)),
+        'total_ms_p50' : float(np.percentile(total_ms,50)),
+        'total_ms_p95' : float(np.percentile(total_ms,95)),
+        'batch_docs_per_s' : len(documents) / min(batch_s),
+        'featurizer_bytes' : os.path.getsize(featurizer_file),
+        'classifier_bytes' : os.path.getsize(classifier_file),
+        'featurizer_load_s' : featurizer_load_s,
+        'classifier_load_s' : classifier_load_s,
+        'rss_model_bytes' : rss_after - rss_before,
+        'rss_total_bytes' : rss_bytes()
+            }
+    return result
+
+def run_benchmarks(candidates, heldout_file, repeats=3):
+    """Cleans the held-out set and benchmarks each candidate in a new process
+
+    Parameters
+    ----------
+    candidates : list
+        list of (kind, featurizer_file, classifier_file) tuples
+    heldout_file : str
+        labeled review database (see util.load_labeled_reviews)
+    repeats : int, optional
+        number of timed passes for batch throughput. The default is 3.
+
+    Returns
+    -------
+    prepare : dict
+        text_prepare cost, which every candidate pays before vectorizing
+    results : list
+        list of result dicts, one per candidate
+
+    """
+    X, y = util.load_labeled_reviews(heldout_file)
+    prepare_ms = []
+    documents = []
+    for doc in X:
+        start = time.perf_counter()
+        documents.append(util.text_prepare(doc))
+        prepare_ms.append((time.perf_counter() - start)*1000)
+    # Drop documents emptied by the cleaning, as in training
+    y = np.array([y[ii,:] for ii in range(len(documents)) if documents[ii]])
+    documents = [doc for doc in documents if doc]
+    prepare = {
+        'documents' : len(documents),
+        'text_prepare_ms_mean' : float(np.mean(prepare_ms)),
+        'text_prepare_ms_p95' : float(np.percentile(prepare_ms,95))
+            }
+
+    results = []
+    context = multiprocessing.get_context('spawn')
+    for kind, featurizer_file, classifier_file in candidates:
+        with ProcessPoolExecutor(max_workers=1,mp_context=context) as executor:
+            results.append(executor.submit(benchmark_candidate,kind,featurizer_file,
+                                           classifier_file,documents,y,repeats).result())
+    return (prepare, results)
+
+def parse_candidate(text):
+    """Parses a KIND:FEATURIZER:CLASSIFIER command line candidate"""
+    parts = text.split(':')
+    if len(parts) != 3 or parts[0] not in featurizer_kinds:
+        raise argparse.ArgumentTypeError(
+            "candidate must be KIND:FEATURIZER:CLASSIFIER with KIND in {}".format(featurizer_kinds))
+    return tuple(parts)
+
+def print_results(prepare, results, budget_ms=None):
+    """Prints a summary table of benchmark results"""
+    print("Held-out documents: {}, text_prepare mean {:.2f} ms, p95 {:.2f} ms".format(
+        prepare['documents'],prepare['text_prepare_ms_mean'],prepare['text_prepare_ms_p95']))
+    header = "{:<40} {:>6} {:>6} {:>9} {:>9} {:>9} {:>9} {:>10} {:>9} {:>8} {:>9}".format(
+        'candidate','acc','fbeta','vec p50','vec p95','score p95','total p95','docs/s','size MB','load s','RSS MB')
+    print(header)
+    print('-'*len(header))
+    for res in results:
+        name = "{}:{}".format(res['kind'],os.path.basename(res['featurizer']))
+        line = "{:<40} {:>6.3f} {:>6.3f} {:>9.2f} {:>9.2f} {:>9.2f} {:>9.2f} {:>10.1f} {:>9.2f} {:>8.2f} {:>9.1f}".format(
+            name[:40],res['mean_accuracy'],res['mean_fbeta'],
+            res['vectorize_ms_p50'],res['vectorize_ms_p95'],res['score_ms_p95'],res['total_ms_p95'],
+            res['batch_docs_per_s'],
+            (res['featurizer_bytes']+res['classifier_bytes'])/1e6,
+            res['featurizer_load_s']+res['classifier_load_s'],
+            res['rss_model_bytes']/1e6)
+        if budget_ms is not None and prepare['text_prepare_ms_p95'] + res['total_ms_p95'] > budget_ms:
+            line += '  OVER BUDGET'
+        print(line)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark accuracy and serving cost of PLAYGROUNDr model candidates")
+    parser.add_argument('heldout', help="held-out labeled review database (JSON lines)")
+    parser.add_argument('candidates', nargs='+', type=parse_candidate,
+                        help="candidate models as KIND:FEATURIZER:CLASSIFIER")
+    parser.add_argument('--repeats', type=int, default=3, help="timed passes for batch throughput")
+    parser.add_argument('--budget-ms', type=float, default=None,
+                        help="per-document latency budget (text_prepare p95 + vectorize-and-score p95)")
+    parser.add_argument('--output', default=None, help="optional JSON file for the full results")
+    args = parser.parse_args()
+
+    prepare, results = run_benchmarks(args.candidates, args.heldout, args.repeats)
+    print_results(prepare, results, args.budget_ms)
+    if args.output:
+        with open(args.output,'w') as fp:
+            json.dump({'prepare' : prepare, 'results' : results}, fp, indent=2)
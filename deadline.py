@@ -0,0 +1,280 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+...................Request deadlines for PLAYGROUNDr web app...................
+Author: James Bramante
+Date: February 21, 2020
+
+This module contains the Deadline class, which carries a request's time
+budget through Google Places calls and review scoring so that a slow call
+yields a partial response instead of holding up the whole request, and the
+AdmissionControl class, which bounds the number of requests the server works
+on at once so that latency stays bounded under overload.
+
+AdmissionControl with a state_dir requires psutil.
+"""
+
+import os
+import threading
+import time
+
+class DeadlineExceeded(Exception):
+    """Raised when a request's time budget runs out"""
+    pass
+
+class Deadline(object):
+    """A time budget for a request, shared by everything the request calls
+
+    Attributes
+    ----------
+    budget : float
+        total time budget, in seconds
+    expires : float
+        time.monotonic() value at which the budget runs out
+    partial : bool
+        True once any work was dropped because the budget ran out
+    parent : Deadline
+        the deadline this one was split from with reserve, or None
+
+    Methods
+    -------
+    remaining(self):
+        Seconds left in the budget
+    expired(self):
+        Whether the budget has run out
+    timeout(self, cap=None):
+        Seconds to allow for the next blocking call
+    mark_partial(self):
+        Record that some work was dropped
+    reserve(self, seconds):
+        A deadline that runs out seconds before this one
+    """
+
+    def __init__(self, budget):
+        """
+        Parameters
+        ----------
+        budget : float
+            time budget, in seconds, starting now
+
+        Returns
+        -------
+        None.
+
+        """
+
+        super(Deadline, self).__init__()
+        self.budget = budget
+        self.expires = time.monotonic() + budget
+        self.partial = False
+        self.parent = None
+
+    def remaining(self):
+        """Seconds left in the budget, never negative"""
+        return max(0.0, self.expires - time.monotonic())
+
+    def expired(self):
+        """Whether the budget has run out"""
+        return time.monotonic() >= self.expires
+
+    def timeout(self, cap=None):
+        """Seconds to allow for the next blocking call
+
+        Parameters
+        ----------
+        cap : float, optional
+            upper limit on the timeout, e.g. a per-call timeout
+
+        Raises
+        ------
+        DeadlineExceeded
+            if the budget has already run out
+
+        Returns
+        -------
+        float
+            the smaller of the remaining budget and cap
+
+        """
+        remaining = self.remaining()
+        if remaining <= 0:
+            self.mark_partial()
+            raise DeadlineExceeded("Request deadline of {} s exceeded".format(self.budget))
+        if cap is not None:
+            return min(remaining, cap)
+        return remaining
+
+    def mark_partial(self):
+        """Record that some work was dropped because the budget ran out"""
+        self.partial = True
+        if self.parent is not None:
+            self.parent.mark_partial()
+
+    def reserve(self, seconds):
+        """A deadline that runs out seconds before this one
+
+        Use it for one stage of a request (e.g. the Google calls) to keep
+        time for the stages after it. Marking it partial marks this
+        deadline partial too.
+
+        Parameters
+        ----------
+        seconds : float
+            time to keep back for the later stages
+
+        Returns
+        -------
+        Deadline
+            the earlier deadline
+
+        """
+        child = Deadline(max(0.0, self.remaining() - seconds))
+        child.parent = self
+        return child
+
+class AdmissionControl(object):
+    """Limits the number of requests the server works on at once
+
+    Requests beyond degrade_limit are admitted in degraded mode (callers
+    should do less work for them); requests beyond reject_limit are refused.
+
+    With a state_dir, requests are counted across all of the worker
+    processes sharing the directory: each worker writes its own count to a
+    file named by its process ID and start time, and counts from workers
+    that have exited are ignored and removed, even if their process ID has
+    since been reused. This is what makes the limits reachable with gunicorn
+    sync workers, which each work on one request at a time. Without a
+    state_dir, only this process's requests are counted (e.g. for threaded
+    workers).
+
+    Workers read each other's counts and then update their own without a
+    lock shared between processes, so requests arriving at the same moment
+    in different workers can all be admitted. The limits are soft.
+
+    Attributes
+    ----------
+    degrade_limit : int
+        number of requests in flight above which new requests are degraded
+    reject_limit : int
+        number of requests in flight above which new requests are rejected
+    state_dir : str
+        directory holding each worker's in-flight count, or None
+    inflight : int
+        number of requests currently admitted by this process
+    rejected : int
+        total number of requests rejected by this process
+
+    Methods
+    -------
+    admit(self):
+        Admit a request, returning ADMIT, DEGRADE, or REJECT
+    release(self):
+        Mark an admitted request as finished
+    total_inflight(self):
+        Number of requests in flight in all workers
+    """
+
+    ADMIT = 'admit'
+    DEGRADE = 'degrade'
+    REJECT = 'reject'
+
+    def __init__(self, degrade_limit, reject_limit, state_dir=None):
+        """
+        Parameters
+        ----------
+        degrade_limit : int
+            number of requests in flight above which new requests are degraded
+        reject_limit : int
+            number of requests in flight above which new requests are rejected
+        state_dir : str, optional
+            directory in which workers share their in-flight counts. The
+            default counts this process's requests only.
+
+        Returns
+        -------
+        None.
+
+        """
+
+        super(AdmissionControl, self).__init__()
+        self.degrade_limit = degrade_limit
+        self.reject_limit = reject_limit
+        self.state_dir = state_dir
+        self.inflight = 0
+        self.rejected = 0
+        self._lock = threading.Lock()
+        if state_dir:
+            os.makedirs(state_dir, exist_ok=True)
+
+    def admit(self):
+        """Admit a request, returning ADMIT, DEGRADE, or REJECT
+
+        Every request admitted with ADMIT or DEGRADE must call release when it
+        finishes. Rejected requests must not.
+        """
+        with self._lock:
+            others = self._other_inflight()
+            if self.inflight + others >= self.reject_limit:
+                self.rejected += 1
+                return self.REJECT
+            self.inflight += 1
+            self._write_inflight()
+            if self.inflight + others > self.degrade_limit:
+                return self.DEGRADE
+            return self.ADMIT
+
+    def release(self):
+        """Mark an admitted request as finished"""
+        with self._lock:
+            self.inflight -= 1
+            self._write_inflight()
+
+    def total_inflight(self):
+        """Number of requests in flight in all workers sharing state_dir"""
+        with self._lock:
+            return self.inflight + self._other_inflight()
+
+    def _write_inflight(self):
+        """Publish this process's in-flight count. Call with _lock held"""
+        if not self.state_dir:
+            return
+        name = self._process_name(os.getpid())
+        filename = os.path.join(self.state_dir, name)
+        temp_filename = os.path.join(self.state_dir, '.' + name)
+        with open(temp_filename, 'w') as fp:
+            fp.write(str(self.inflight))
+        os.replace(temp_filename, filename)
+
+    @staticmethod
+    def _process_name(pid):
+        """Names a process by its ID and start time, or None if it has exited"""
+        import psutil
+        try:
+            return '{}-{:.2f}'.format(pid, psutil.Process(pid).create_time())
+        except psutil.NoSuchProcess:
+            return None
+
+    def _other_inflight(self):
+        """Sum the in-flight counts of the other live workers"""
+        if not self.state_dir:
+            return 0
+        own_name = self._process_name(os.getpid())
+        total = 0
+        for name in os.listdir(self.state_dir):
+            if name.startswith('.') or name == own_name:
+                continue
+            filename = os.path.join(self.state_dir, name)
+            pid = name.split('-')[0]
+            if not pid.isdigit() or self._process_name(int(pid)) != name:
+                # A worker that exited, perhaps mid-request
+                try:
+                    os.remove(filename)
+                except OSError:
+                    pass
+                continue
+            try:
+                with open(filename, 'r') as fp:
+                    total += int(fp.read() or 0)
+            except (OSError, ValueError):
+                continue
+        return total
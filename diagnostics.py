@@ -0,0 +1,308 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+....................Memory diagnostics for PLAYGROUNDr web app..................
+Author: James Bramante
+Date: February 19, 2020
+
+This module reports how much memory a web app worker is using and where it
+went: the worker's resident set size (RSS), the size of each loaded model
+component, and the top allocation sites from tracemalloc snapshots, which can
+be diffed between two points in time to find growth (e.g. before and after a
+burst of /multipark requests).
+
+Diagnostics are opt-in. Set the environment variable
+PLAYGROUNDR_DIAGNOSTICS=1 to enable them; tracemalloc then starts when this
+module is imported, so import it before the modules whose memory you want to
+attribute (util, gensim, nltk). PLAYGROUNDR_TRACEMALLOC_FRAMES sets the
+number of stack frames stored per allocation (default 1). Tracing slows the
+app down and uses extra memory, so leave it off in normal operation.
+
+This script requires psutil.
+"""
+
+from collections import defaultdict
+import gc
+import os
+import sys
+import threading
+import time
+import tracemalloc
+
+enabled = os.environ.get('PLAYGROUNDR_DIAGNOSTICS', '') == '1'
+trace_frames = int(os.environ.get('PLAYGROUNDR_TRACEMALLOC_FRAMES', '1'))
+if enabled and not tracemalloc.is_tracing():
+    tracemalloc.start(trace_frames)
+
+# Allocations that belong to the tracing machinery rather than the app
+_snapshot_filters = [
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+        tracemalloc.Filter(False, '<frozen importlib._bootstrap_external>'),
+        tracemalloc.Filter(False, '<unknown>'),
+        ]
+
+# Snapshots saved by label, per worker process
+_snapshots = {}
+_snapshot_lock = threading.Lock()
+key_types = ['filename', 'lineno', 'traceback'] # tracemalloc groupings
+
+def rss_bytes():
+    """Returns the resident set size of the current process, in bytes"""
+    import psutil
+    return psutil.Process(os.getpid()).memory_info().rss
+
+def deep_sizeof(obj, seen=None):
+    """Estimates the memory used by an object and everything it references
+
+    Follows containers and instance attributes. NumPy arrays report their own
+    data buffers (views count only their headers), and SciPy sparse matrices
+    are counted through their data arrays. Objects reachable from more than
+    one place are counted once.
+
+    Parameters
+    ----------
+    obj : object
+        the object to measure
+    seen : set, optional
+        ids of objects already counted. The default is a new set.
+
+    Returns
+    -------
+    size : int
+        approximate size in bytes
+
+    """
+    if seen is None:
+        seen = set()
+    if id(obj) in seen or isinstance(obj, type) or type(obj).__name__ == 'module':
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, (str, bytes, bytearray, int, float, complex, bool)) \
+            or (hasattr(obj, 'nbytes') and hasattr(obj, 'dtype')):
+        return size
+    if isinstance(obj, dict):
+        for key, value in obj.items():
+            size += deep_sizeof(key, seen) + deep_sizeof(value, seen)
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        for item in obj:
+            size += deep_sizeof(item, seen)
+    if hasattr(obj, '__dict__'):
+        size += deep_sizeof(vars(obj), seen)
+    if hasattr(obj, '__slots__'):
+        for slot in obj.__slots__ if not isinstance(obj.__slots__, str) else [obj.__slots__]:
+            if hasattr(obj, slot):
+                size += deep_sizeof(getattr(obj, slot), seen)
+    return size
+
+def component_sizes(models):
+    """Estimates the size of each model component loaded by the app
+
+    Parameters
+    ----------
+    models : ModelRegistry.ModelSet
+        the models in use
+
+    Returns
+    -------
+    sizes : dict
+        component name : approximate size in bytes. Components that have not
+        been loaded in this worker are omitted.
+
+    """
+    import util
+    sizes = {
+        'clf' : deep_sizeof(models.clf),
+        'tfidf_model' : deep_sizeof(models.tfidf_model),
+        'stopwords' : deep_sizeof(util.STOPWORDS)
+            }
+    vocabulary = getattr(models.tfidf_model, 'vocabulary_', None)
+    if vocabulary is not None:
+        sizes['tfidf_vocabulary'] = deep_sizeof(vocabulary)
+    stop_words = getattr(models.tfidf_model, 'stop_words_', None)
+    if stop_words is not None:
+        # Only needed for fitting; safe to discard before pickling
+        sizes['tfidf_stop_words_'] = deep_sizeof(stop_words)
+    # WordNet is loaded lazily by the lemmatizer on first use
+    wordnet = getattr(sys.modules.get('nltk.corpus'), 'wordnet', None)
+    if wordnet is not None and type(wordnet).__name__ != 'LazyCorpusLoader':
+        sizes['wordnet'] = deep_sizeof(wordnet)
+    return sizes
+
+def take_snapshot(label='baseline'):
+    """Takes a tracemalloc snapshot and saves it under a label
+
+    Parameters
+    ----------
+    label : str, optional
+        name under which to save the snapshot. The default is 'baseline'.
+
+    Returns
+    -------
+    dict
+        label, time, and total traced memory of the snapshot
+
+    """
+    if not tracemalloc.is_tracing():
+        raise RuntimeError("tracemalloc is not running; set PLAYGROUNDR_DIAGNOSTICS=1")
+    gc.collect()
+    snapshot = tracemalloc.take_snapshot().filter_traces(_snapshot_filters)
+    with _snapshot_lock:
+        _snapshots[label] = (time.time(), snapshot)
+    return {
+        'pid' : os.getpid(),
+        'label' : label,
+        'time' : _snapshots[label][0],
+        'traced_bytes' : sum([stat.size for stat in snapshot.statistics('filename')])
+            }
+
+def _format_stat(stat, key_type):
+    """Converts a tracemalloc Statistic or StatisticDiff to a dict"""
+    out = {
+        'site' : str(stat.traceback) if key_type == 'traceback' else str(stat.traceback[0]),
+        'size_bytes' : stat.size,
+        'count' : stat.count
+            }
+    if hasattr(stat, 'size_diff'):
+        out['size_diff_bytes'] = stat.size_diff
+        out['count_diff'] = stat.count_diff
+    return out
+
+def top_allocations(limit=20, key_type='lineno'):
+    """Lists the allocation sites currently holding the most memory
+
+    Parameters
+    ----------
+    limit : int, optional
+        number of sites to return. The default is 20.
+    key_type : str, optional
+        tracemalloc grouping: 'filename', 'lineno', or 'traceback'. The
+        default is 'lineno'.
+
+    Returns
+    -------
+    list
+        list of dicts with the site, size, and number of allocations
+
+    """
+    if not tracemalloc.is_tracing():
+        return []
+    snapshot = tracemalloc.take_snapshot().filter_traces(_snapshot_filters)
+    return [_format_stat(stat, key_type) for stat in snapshot.statistics(key_type)[:limit]]
+
+def package_allocations(limit=20):
+    """Totals currently traced memory by the top-level package that allocated it
+
+    Only allocations made after tracing started are counted, so enable
+    diagnostics before importing the app to attribute import costs (e.g.
+    gensim, nltk, sklearn).
+
+    Parameters
+    ----------
+    limit : int, optional
+        number of packages to return. The default is 20.
+
+    Returns
+    -------
+    dict
+        package name : traced bytes, largest first
+
+    """
+    if not tracemalloc.is_tracing():
+        return {}
+    totals = defaultdict(int)
+    snapshot = tracemalloc.take_snapshot().filter_traces(_snapshot_filters)
+    for stat in snapshot.statistics('filename'):
+        filename = stat.traceback[0].filename
+        parts = filename.replace('\\', '/').split('/')
+        if 'site-packages' in parts and parts.index('site-packages') + 1 < len(parts):
+            package = parts[parts.index('site-packages') + 1]
+        else:
+            package = os.path.basename(filename)
+        totals[package] += stat.size
+    ordered = sorted(totals.items(), key=lambda item: -item[1])[:limit]
+    return dict(ordered)
+
+def diff_snapshots(label='baseline', against=None, limit=20, key_type='lineno'):
+    """Compares two snapshots and lists the sites whose memory grew the most
+
+    Parameters
+    ----------
+    label : str, optional
+        label of the earlier snapshot. The default is 'baseline'.
+    against : str, optional
+        label of the later snapshot. The default is a new snapshot.
+    limit : int, optional
+        number of sites to return. The default is 20.
+    key_type : str, optional
+        tracemalloc grouping: 'filename', 'lineno', or 'traceback'. The
+        default is 'lineno'.
+
+    Raises
+    ------
+    KeyError
+        if there is no snapshot with either label in this worker
+    ValueError
+        if key_type is not one of key_types
+
+    Returns
+    -------
+    dict
+        worker process ID, total growth, and the top sites by size difference
+
+    """
+    if key_type not in key_types:
+        raise ValueError("group must be one of {}".format(key_types))
+    with _snapshot_lock:
+        if label not in _snapshots:
+            raise KeyError("No snapshot named {}".format(label))
+        start_time, start = _snapshots[label]
+        if against is not None:
+            if against not in _snapshots:
+                raise KeyError("No snapshot named {}".format(against))
+            end_time, end = _snapshots[against]
+    if against is None:
+        gc.collect()
+        end_time, end = time.time(), tracemalloc.take_snapshot().filter_traces(_snapshot_filters)
+    stats = end.compare_to(start, key_type)
+    return {
+        'pid' : os.getpid(),
+        'from' : label,
+        'to' : against or 'now',
+        'seconds' : end_time - start_time,
+        'size_diff_bytes' : sum([stat.size_diff for stat in stats]),
+        'top' : [_format_stat(stat, key_type) for stat in stats[:limit]]
+            }
+
+def report(models, limit=20):
+    """Collects a memory report for the current worker
+
+    Parameters
+    ----------
+    models : ModelRegistry.ModelSet
+        the models in use
+    limit : int, optional
+        number of allocation sites and packages to list. The default is 20.
+
+    Returns
+    -------
+    dict
+        RSS, model component sizes, and tracemalloc statistics
+
+    """
+    out = {
+        'pid' : os.getpid(),
+        'rss_bytes' : rss_bytes(),
+        'model_version' : models.version,
+        'components' : component_sizes(models),
+        'tracing' : tracemalloc.is_tracing(),
+        'snapshots' : sorted(_snapshots.keys())
+            }
+    if tracemalloc.is_tracing():
+        current, peak = tracemalloc.get_traced_memory()
+        out['traced_bytes'] = current
+        out['traced_peak_bytes'] = peak
+        out['top_allocations'] = top_allocations(limit)
+        out['packages'] = package_allocations(limit)
+    return out
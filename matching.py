@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+...................Park database matching for PLAYGROUNDr......................
+Author: James Bramante
+Date: February 17, 2020
+
+This module can be imported to reconcile park databases (e.g. the Toronto,
+Pennsylvania, Rhode Island, and Florida databases) with each other or with
+Google Places names, as done in PLAYGROUNDr_model_training.ipynb.
+
+Comparing every record in one database with every record in another quickly
+becomes too slow as more cities are added. match_records instead blocks
+candidate pairs by geographic grid cell, so that only records in the same or
+a neighboring cell are compared, and scores the blocks in parallel. Cells are
+at least max_distance_km across, so no pair within max_distance_km is missed
+and match_records returns the same pairs as brute_force_match.
+
+Blocking is geographic only. The default scorer gives 100 to any two names
+sharing a token such as "park", and high scores to names sharing few
+characters, so an index of the names can't rule out a useful fraction of
+pairs at typical thresholds. brute_force_match is kept for checking new
+scorers and for tests.
+
+Records are dicts with a 'name' and, optionally, 'lat' and 'lng'. Records
+without coordinates are compared on name alone.
+
+This module requires fuzzywuzzy.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+from collections import defaultdict
+from fuzzywuzzy import fuzz
+import math
+import re
+
+# Abbreviations to expand before comparing names, as in the training notebook
+name_abbreviations = [
+        (r'\bcc\b', 'community centre'),
+        (r'\bcrc\b', 'community recreation centre'),
+        (r'\bctr\b', 'centre'),
+        (r'\bpk\b', 'park'),
+        (r'\brec\b', 'recreation'),
+        ]
+NAME_SYMBOLS_RE = re.compile('[^0-9a-z ]') # Symbols to remove from names
+earth_radius_km = 6371.0
+cell_margin = 1.000001 # Widens grid cells against rounding in distance_km
+
+def normalize_name(name):
+    """Normalizes a place name for comparison
+
+    Parameters
+    ----------
+    name : str
+        a place name
+
+    Returns
+    -------
+    name : str
+        lowercased name with abbreviations expanded and symbols removed
+
+    """
+    name = str(name).lower()
+    name = re.sub(NAME_SYMBOLS_RE, ' ', name)
+    for pattern, replacement in name_abbreviations:
+        name = re.sub(pattern, replacement, name)
+    return ' '.join(name.split())
+
+def default_scorer(name1, name2):
+    """Scores the similarity of two normalized names, from 0 to 100
+
+    Uses the same fuzzywuzzy comparison as the training notebook.
+    """
+    return fuzz.partial_token_set_ratio(name1, name2)
+
+def distance_km(record1, record2):
+    """Returns the great-circle distance between two records, in km"""
+    lat1, lng1 = math.radians(record1['lat']), math.radians(record1['lng'])
+    lat2, lng2 = math.radians(record2['lat']), math.radians(record2['lng'])
+    hav = math.sin((lat2-lat1)/2)**2 + math.cos(lat1)*math.cos(lat2)*math.sin((lng2-lng1)/2)**2
+    return 2*earth_radius_km*math.asin(min(1.0,math.sqrt(hav)))
+
+def has_location(record):
+    """Returns True if a record has usable coordinates"""
+    return record.get('lat') is not None and record.get('lng') is not None \
+        and not (math.isnan(record['lat']) or math.isnan(record['lng']))
+
+def is_near(record1, record2, max_distance_km):
+    """Returns True if two records are within max_distance_km of each other
+
+    Records without coordinates are always considered near.
+    """
+    if max_distance_km is None or not has_location(record1) or not has_location(record2):
+        return True
+    return distance_km(record1, record2) <= max_distance_km
+
+def brute_force_match(left, right, threshold=50, scorer=default_scorer, max_distance_km=1.0):
+    """Matches records by comparing every left record with every right record
+
+    Parameters
+    ----------
+    left : list
+        list of record dicts
+    right : list
+        list of record dicts
+    threshold : float, optional
+        minimum score for a match. The default is 50.
+    scorer : function, optional
+        function scoring two normalized names from 0 to 100. The default is
+        default_scorer.
+    max_distance_km : float, optional
+        maximum distance between matched records with coordinates. None
+        disables the distance check. The default is 1.0.
+
+    Returns
+    -------
+    pairs : list
+        sorted list of (left index, right index, score) tuples
+
+    """
+    left_names = [normalize_name(rec['name']) for rec in left]
+    right_names = [normalize_name(rec['name']) for rec in right]
+    pairs = []
+    for ii in range(len(left)):
+        for jj in range(len(right)):
+            if is_near(left[ii], right[jj], max_distance_km):
+                score = scorer(left_names[ii], right_names[jj])
+                if score >= threshold:
+                    pairs.append((ii, jj, score))
+    return pairs
+
+class _Blocker(object):
+    """Geographic grid over the right records
+
+    max_lat should be the largest absolute latitude of any record to be
+    looked up, so that cells are wide enough at every latitude.
+    """
+
+    def __init__(self, right, cell_size_km, max_lat=0.0):
+        self.right = right
+        self.names = [normalize_name(rec['name']) for rec in right]
+        # A pair within cell_size_km differs by at most lat_step in latitude
+        # and lng_step in longitude (from the haversine formula), so the
+        # neighbors of a record's cell contain every record that close
+        self.lat_step = None
+        self.lng_step = None
+        if cell_size_km:
+            angle = cell_size_km / earth_radius_km
+            self.lat_step = math.degrees(angle) * cell_margin
+            cos_lat = math.cos(math.radians(min(max_lat, 90.0)))
+            if cos_lat > math.sin(angle/2):
+                self.lng_step = math.degrees(2*math.asin(math.sin(angle/2) / cos_lat)) * cell_margin
+            else:
+                self.lng_step = 360.0
+        self.by_cell = defaultdict(list) # cell -> right indices
+        for jj, record in enumerate(right):
+            self.by_cell[self.cell(record)].append(jj)
+
+    def cell(self, record):
+        """Returns the grid cell of a record, or None without coordinates"""
+        if self.lat_step is None or not has_location(record):
+            return None
+        return (int(math.floor(record['lat']/self.lat_step)), int(math.floor(record['lng']/self.lng_step)))
+
+    def candidates(self, record):
+        """Returns the right indices in the record's or neighboring cells"""
+        cell = self.cell(record)
+        if cell is None:
+            return range(len(self.right))
+        found = list(self.by_cell.get(None, []))
+        for di in (-1,0,1):
+            for dj in (-1,0,1):
+                found.extend(self.by_cell.get((cell[0]+di, cell[1]+dj), []))
+        return found
+
+# Per-process state for parallel block scoring
+_worker_state = {}
+
+def _init_worker(blocker, threshold, scorer, max_distance_km):
+    _worker_state['args'] = (blocker, threshold, scorer, max_distance_km)
+
+def _score_block(block):
+    """Scores the candidate pairs for a block of (index, record) tuples"""
+    blocker, threshold, scorer, max_distance_km = _worker_state['args']
+    pairs = []
+    for ii, record in block:
+        name = normalize_name(record['name'])
+        for jj in blocker.candidates(record):
+            if is_near(record, blocker.right[jj], max_distance_km):
+                score = scorer(name, blocker.names[jj])
+                if score >= threshold:
+                    pairs.append((ii, jj, score))
+    return pairs
+
+def match_records(left, right, threshold=50, scorer=default_scorer, max_distance_km=1.0, n_jobs=1):
+    """Matches records, scoring only pairs within geographic blocks
+
+    Parameters
+    ----------
+    left : list
+        list of record dicts
+    right : list
+        list of record dicts
+    threshold : float, optional
+        minimum score for a match. The default is 50.
+    scorer : function, optional
+        module-level function scoring two normalized names from 0 to 100.
+        The default is default_scorer.
+    max_distance_km : float, optional
+        maximum distance between matched records with coordinates, also used
+        as the grid cell size. None disables geographic blocking. The
+        default is 1.0.
+    n_jobs : int, optional
+        number of processes over which to score blocks. The default is 1.
+
+    Returns
+    -------
+    pairs : list
+        sorted list of (left index, right index, score) tuples, the same as
+        brute_force_match returns for the same arguments
+
+    """
+    max_lat = max([abs(rec['lat']) for rec in left + right if has_location(rec)] + [0.0])
+    blocker = _Blocker(right, max_distance_km, max_lat)
+
+    # One block per geographic cell of left records
+    blocks = defaultdict(list)
+    for ii, record in enumerate(left):
+        blocks[blocker.cell(record)].append((ii, record))
+    blocks = list(blocks.values())
+
+    if n_jobs <= 1 or len(blocks) <= 1:
+        _init_worker(blocker, threshold, scorer, max_distance_km)
+        results = [_score_block(block) for block in blocks]
+    else:
+        with ProcessPoolExecutor(max_workers=n_jobs, initializer=_init_worker,
+                                 initargs=(blocker, threshold, scorer, max_distance_km)) as executor:
+            results = list(executor.map(_score_block, blocks, chunksize=max(1,len(blocks)//(4*n_jobs))))
+    return sorted([pair for result in results for pair in result])
+
+def best_matches(pairs):
+    """Reduces matched pairs to the highest-scoring right record per left
+
+    Parameters
+    ----------
+    pairs : list
+        list of (left index, right index, score) tuples
+
+    Returns
+    -------
+    best : dict
+        left index : (right index, score). Ties go to the lower right index.
+
+    """
+    best = {}
+    for ii, jj, score in pairs:
+        if ii not in best or score > best[ii][1]:
+            best[ii] = (jj, score)
+    return best
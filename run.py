@@ -11,13 +11,19 @@ requests from the web frontend. It
 This script requires all of the PLAYGROUNDr web app modules, Flask, and geopy.
 """
 
+# Import diagnostics first, so that when enabled, tracemalloc can attribute
+# the memory used by the other modules' imports
+import diagnostics
 from flask import render_template, request, Flask, jsonify
 from GooglePlaces import GooglePlaces
+from deadline import Deadline, DeadlineExceeded, AdmissionControl
+from Gazetteer import Gazetteer
 from geopy.distance import geodesic 
-from util import process_review
+from util import process_review, model_registry
 from flask_bootstrap import Bootstrap
 import numpy as np
 import json
+import os
 
 # Variables used within the other methods
 # To keep Google API_KEY secret, I've written two ways to enter the API KEY. 
@@ -32,10 +38,48 @@ gp = GooglePlaces(API_KEY, search_radius) # Object that interfaces with Google A
 # Variables useful for map display
 init_origin = {"lat": 43.65, "lng": -79.38}
 init_zoom = 12
-search_query = 'park' #Type of Google Place to search for
+search_types = ['park'] #Types of Google Place to search for
+# Text searches that find amenities Google doesn't tag as parks
+search_text_queries = ['playground', 'splash pad', 'swimming pool', 'ice rink', 'dog park', 'sports field']
+max_remote_calls = 30 #Maximum Google API calls (searches + reviews) per /multipark
+degraded_max_remote_calls = 15 #Maximum Google API calls per /multipark under load
 max_results = 5#Maximum number of place results to display
 max_walk = 1 #Maximum walking distance, in km, from user survey
 
+# Variables that bound request latency. Each request gets a time budget for
+# Google calls and scoring; past the budget, the parks ready so far are
+# returned and the response is flagged partial. Past degrade_inflight
+# concurrent /multipark requests, new requests get a smaller budget and fewer
+# parks; past max_inflight, they are rejected.
+request_budget = 8.0 #Time budget per request, in seconds
+degraded_budget = 4.0 #Time budget per request under load, in seconds
+scoring_reserve = 1.5 #Seconds of each budget kept back from Google calls for scoring
+max_details = None #Maximum number of parks to request reviews for (None: all)
+degraded_max_details = 10 #Maximum number of parks to request reviews for under load
+# Requests are counted across all workers, as each gunicorn sync worker only
+# works on one at a time. The limits scale with WEB_CONCURRENCY, which gunicorn
+# also uses as its default number of workers: degrade once half the workers
+# are busy with /multipark, and reject rather than tie up the last worker, so
+# it stays free for the other routes
+num_workers = int(os.environ.get('WEB_CONCURRENCY', 1)) #Number of gunicorn workers
+degrade_inflight = max(1, num_workers // 2) #Concurrent /multipark requests above which to degrade
+max_inflight = max(2, num_workers - 1) #Concurrent /multipark requests above which to reject
+admission_dir = "data/admission" # In-flight counts, shared by workers
+admission_control = AdmissionControl(degrade_inflight, max_inflight, admission_dir)
+
+# Local index of location bar queries, checked before asking Google to
+# geocode them. Filled from previous lookups and, optionally, an offline
+# place-name file
+gazetteer_file_name = "data/gazetteer.jsonl" # Previous lookups, shared by workers
+gazetteer_seed_file_name = "data/gazetteer_seed.csv" # Optional offline place names
+gazetteer = Gazetteer(gazetteer_file_name, gazetteer_seed_file_name)
+max_suggestions = 10 #Maximum number of autocomplete suggestions
+
+# Load the models before serving the first request. Polling for new model
+# versions starts with the first request in each worker, so a gunicorn
+# --preload master never polls
+model_registry.preload()
+
 # Start the application instance
 application = Flask(__name__, template_folder="templates")
 Bootstrap(application)
@@ -46,18 +90,74 @@ def index():
     """Renders the front-end mainmap page template
     
     Looks for optional 'location_field' input from the user and uses that to
-    initialize the center of the Google map on the mainmap page.
+    initialize the center of the Google map on the mainmap page. The location
+    is looked up in the gazetteer first, and in Google Places on a miss.
     """
     if request.form:
-        candidate = gp.place_coordinate_by_textquery(request.form['location_field'])
-        if candidate['candidates']:
-            origin = candidate['candidates'][0]['geometry']['location']
-        else:
+        origin = gazetteer.geocode(request.form['location_field'], geocode_remote)
+        if origin is None:
             origin = init_origin
     else:
         origin = init_origin
     return render_template('mainmap.html', origin=json.dumps(origin), zoom=init_zoom,apikey = API_KEY,name = "Location Name", status = 'Directions: Click on a park to get amenities for that park, click anywhere else to search for nearby parks with the chosen amenities.', address = "Address")
 
+def geocode_remote(query):
+    """Finds location coordinates for a text query with Google Places
+    
+    Parameters
+    ----------
+    query : str
+        location text query
+    
+    Returns
+    -------
+    dict
+        {'lat', 'lng'} coordinates and Google's 'name' for the place, or None
+        if Google found no candidates or didn't answer within the time budget
+    """
+    try:
+        candidate = gp.place_coordinate_by_textquery(query, Deadline(request_budget))
+    except DeadlineExceeded:
+        return None
+    if candidate['candidates']:
+        location = dict(candidate['candidates'][0]['geometry']['location'])
+        location['name'] = candidate['candidates'][0].get('name')
+        return location
+    return None
+
+@application.route('/autocomplete', methods=['GET'])
+def autocomplete():
+    """Suggests seeded and previously searched places that start with some text
+    
+    'GET' input
+    -----------
+    'q' : str
+        Partial location text typed into the location bar
+    
+    Returns
+    -------
+    json str
+        A jsonified dict with a list of suggested location names and
+        coordinates
+    """
+    return(jsonify({"results" : gazetteer.prefix(request.args.get('q', ''), max_suggestions)}))
+
+@application.route('/metrics', methods=['GET'])
+def metrics():
+    """Reports this worker's cache hit rates, load, and model version
+    
+    Returns
+    -------
+    json str
+        A jsonified dict of metrics for the worker that handled the request
+    """
+    return(jsonify({
+            "gazetteer" : gazetteer.stats(),
+            "model_version" : model_registry.current().version,
+            "multipark_inflight" : admission_control.total_inflight(),
+            "multipark_rejected" : admission_control.rejected
+            }))
+
 # This route gets called when a user has clicked on a location with a placeid
 @application.route('/singlepark', methods=['POST'])
 def single_park_amenities():
@@ -72,13 +172,19 @@ def single_park_amenities():
     -------
     json str
         A jsonified dict of location information, including predicted amenities
+        and the version of the models that made the predictions
     """
     placeid = request.form['placeid']
+    models = model_registry.current()
+    deadline = Deadline(request_budget)
     
     # Extract details with Google API
-    reviews = gp.place_reviews(placeid)
+    try:
+        reviews = gp.place_reviews(placeid, deadline)
+    except DeadlineExceeded:
+        return(jsonify({"results" : [], "model_version" : models.version, "partial" : True}), 504)
     reviews = reviews['result']
-    out_dict = {"results" : [process_review(reviews)]}
+    out_dict = {"results" : [process_review(reviews, models)], "model_version" : models.version}
     return(jsonify(out_dict))
     
     
@@ -99,14 +205,52 @@ def multi_park_amenities():
     -------
     json str
         A jsonified dict of location information, including predicted amenities
-        for up to maximum number of locations within proximity
+        for up to maximum number of locations within proximity, the version of
+        the models that made the predictions, whether the results are partial
+        because the time budget ran out, and whether the request was degraded
+        because the server is under load. Responds 503 if the server is
+        overloaded.
+    """
+    admission = admission_control.admit()
+    if admission == AdmissionControl.REJECT:
+        return(jsonify({"results" : [], "partial" : True, "error" : "Server busy"}), 503, {"Retry-After" : "1"})
+    try:
+        return(jsonify(find_parks(admission == AdmissionControl.DEGRADE)))
+    finally:
+        admission_control.release()
+
+def find_parks(degraded=False):
+    """Finds, scores, and ranks the parks near the /multipark target location
+    
+    Parameters
+    ----------
+    degraded : bool, optional
+        whether to use the smaller time budget and park limit for servers
+        under load. The default is False.
+    
+    Returns
+    -------
+    dict
+        the /multipark response
     """
+    # Use one model version for the whole request, even if a new version is
+    # swapped in part-way through
+    models = model_registry.current()
     lat = float(request.form['lat'])
     lon = float(request.form['lon'])
     options = np.array([1 if x else 0 for x in json.loads(request.form['search'])])
 
-    # Find reviews for all parks within radius of the search location
-    reviews = gp.retrieve_reviews_multi([search_query], [lat,lon])
+    deadline = Deadline(degraded_budget if degraded else request_budget)
+
+    # Find reviews for all parks within radius of the search location,
+    # leaving time to score the parks that were found
+    try:
+        reviews = gp.retrieve_reviews_multi(search_types, [lat,lon], deadline.reserve(scoring_reserve),
+                                            degraded_max_details if degraded else max_details,
+                                            search_text_queries,
+                                            degraded_max_remote_calls if degraded else max_remote_calls)
+    except DeadlineExceeded:
+        reviews = []
     
     # Sometimes Google has duplicate places. Remove duplicates and combine
     # their reviews before passing to the review handler
@@ -114,27 +258,39 @@ def multi_park_amenities():
     reviews_no_duplicates = []
     for review in reviews:
         review = review['result']
+        # Skip Google's placeholder for searches that found nothing
+        if not isinstance(review.get('geometry', {}).get('location'), dict):
+            continue
         if review['name'] not in out_names:
             out_names.append(review['name'])
             reviews_no_duplicates.append(review)
         else:
-            if 'reviews' in reviews_no_duplicates[out_names.index(review['name'])].keys():
+            duplicate = reviews_no_duplicates[out_names.index(review['name'])]
+            if 'reviews' in duplicate.keys():
                 if 'reviews' in review.keys():
-                    reviews_no_duplicates[out_names.index(review['name'])]['reviews'].extend(review['reviews'])
+                    duplicate['reviews'].extend(review['reviews'])
+            duplicate['search_provenance'] = duplicate.get('search_provenance', []) + \
+                [prov for prov in review.get('search_provenance', []) if prov not in duplicate.get('search_provenance', [])]
     
     
     out_dicts = []
     out_dists = []
     out_amens = []
     out_amens_diff = []
+    out_found = []
     # For each review, extract details and calculate distance from the search
     # location
     for review in reviews_no_duplicates:
-        details = process_review(review)
+        # Rank only the parks scored before the time budget runs out
+        if deadline.expired():
+            deadline.mark_partial()
+            break
+        details = process_review(review, models)
         dist = geodesic((lat,lon),(details['location']['lat'],details['location']['lng'])).kilometers
         out_dists.append(dist)
         out_amens.append(sum([float(x) for x in details['scores']]))
         out_amens_diff.append(sum([x-float(y) if x == 1 else 0 for x,y in zip(options,details['scores'])]))
+        out_found.append(len(details['provenance']))
         details['distance'] = str(dist) + ' km'
         out_dicts.append(details)
         
@@ -145,21 +301,84 @@ def multi_park_amenities():
     out_dists2[out_dists2<max_walk] = 0
     # If the user doesn't pass us any options or selected all amenities, pass
     # them the results sorted by number of amenities for distance within 
-    # maximum walking distance, and by distance otherwise
+    # maximum walking distance, and by distance otherwise. Ties go to parks
+    # found by more of the searches
     if sum(options) == 0 or sum(options)==len(options):
-        sorter = np.array(list(zip(list(range(len(out_dists2))),-np.array(out_amens),out_dists2)),dtype=[('index','i4'),('amens','f4'),('dists','f4')])
-        sorter = np.sort(sorter,order=['dists','amens'])
+        sorter = np.array(list(zip(list(range(len(out_dists2))),-np.array(out_amens),out_dists2,-np.array(out_found))),dtype=[('index','i4'),('amens','f4'),('dists','f4'),('found','f4')])
+        sorter = np.sort(sorter,order=['dists','amens','found'])
     else:
         # If the user supplies desired amenities, sort first by number of 
         # amenities that match the desired list, and then by distance and total 
         # amenities
-        sorter = np.array(list(zip(list(range(len(out_dists2))),-np.array(out_amens),out_dists2,out_amens_diff)),dtype=[('index','i4'),('amens','f4'),('dists','f4'),('diff','f4')])
-        sorter = np.sort(sorter,order=['diff','dists','amens'])
+        sorter = np.array(list(zip(list(range(len(out_dists2))),-np.array(out_amens),out_dists2,out_amens_diff,-np.array(out_found))),dtype=[('index','i4'),('amens','f4'),('dists','f4'),('diff','f4'),('found','f4')])
+        sorter = np.sort(sorter,order=['diff','dists','amens','found'])
     
     out_dicts = np.array(out_dicts)
     out_dicts = out_dicts[sorter['index']]
     
-    return(jsonify({"results" : list(out_dicts[0:max_results])}))
+    return({"results" : list(out_dicts[0:max_results]), "model_version" : models.version,
+            "partial" : deadline.partial, "degraded" : degraded})
+
+# Memory diagnostics routes, only registered when PLAYGROUNDR_DIAGNOSTICS=1.
+# Each worker reports on itself, so repeat requests to sample other workers.
+if diagnostics.enabled:
+    @application.route('/diagnostics/memory', methods=['GET'])
+    def memory_report():
+        """Reports this worker's RSS, model sizes, and top allocation sites
+        
+        'GET' input
+        -----------
+        'limit' : int, optional
+            Number of allocation sites to list. The default is 20.
+        """
+        limit = request.args.get('limit', 20, type=int)
+        if limit is None:
+            return(jsonify({"error" : "limit must be an integer", "pid" : os.getpid()}), 400)
+        return(jsonify(diagnostics.report(model_registry.current(), limit)))
+    
+    @application.route('/diagnostics/memory/snapshot', methods=['POST'])
+    def memory_snapshot():
+        """Saves a tracemalloc snapshot in this worker for later diffing
+        
+        'POST' input
+        ------------
+        'label' : str, optional
+            Name under which to save the snapshot. The default is 'baseline'.
+        """
+        label = request.form.get('label', 'baseline')
+        return(jsonify(diagnostics.take_snapshot(label)))
+    
+    @application.route('/diagnostics/memory/diff', methods=['GET'])
+    def memory_diff():
+        """Lists the allocation sites that grew most between two snapshots
+        
+        'GET' input
+        -----------
+        'from' : str, optional
+            Label of the earlier snapshot. The default is 'baseline'.
+        'to' : str, optional
+            Label of the later snapshot. The default is a new snapshot.
+        'limit' : int, optional
+            Number of allocation sites to list. The default is 20.
+        'group' : str, optional
+            'filename', 'lineno', or 'traceback'. The default is 'lineno'.
+        
+        Snapshots are kept per worker, so responds 404, with this worker's
+        pid, if the snapshot was saved by another worker.
+        """
+        limit = request.args.get('limit', 20, type=int)
+        if limit is None:
+            return(jsonify({"error" : "limit must be an integer", "pid" : os.getpid()}), 400)
+        try:
+            diff = diagnostics.diff_snapshots(request.args.get('from', 'baseline'),
+                                              request.args.get('to'),
+                                              limit,
+                                              request.args.get('group', 'lineno'))
+        except KeyError as err:
+            return(jsonify({"error" : str(err.args[0]), "pid" : os.getpid()}), 404)
+        except ValueError as err:
+            return(jsonify({"error" : str(err), "pid" : os.getpid()}), 400)
+        return(jsonify(diff))
         
 if __name__ == "__main__":
     application.run(host='0.0.0.0',debug=True,port=5000)
\ No newline at end of file
@@ -0,0 +1,74 @@
+"""Checks that slow Google calls give partial results within the budget"""
+
+import json
+import os
+import threading
+import time
+import pytest
+
+pytest.importorskip('requests')
+import GooglePlaces
+from deadline import AdmissionControl, Deadline
+
+class FakeResponse(object):
+    def __init__(self, payload):
+        self.content = json.dumps(payload).encode()
+
+@pytest.fixture
+def google(monkeypatch):
+    """A GooglePlaces whose Details call for place 'slow' hangs"""
+    release = threading.Event()
+    def fake_get(endpoint_url, params=None, timeout=None):
+        if 'nearbysearch' in endpoint_url:
+            return FakeResponse({'results' : [{'place_id' : place_id} for place_id in ['fast1', 'slow', 'fast2']]})
+        if 'textsearch' in endpoint_url:
+            return FakeResponse({'results' : []})
+        if params['place_id'] == 'slow':
+            release.wait(10)
+        return FakeResponse({'result' : {'name' : params['place_id'], 'place_id' : params['place_id'],
+                                         'geometry' : {'location' : {'lat' : 43.7, 'lng' : -79.4}}}})
+    monkeypatch.setattr(GooglePlaces.requests, 'get', fake_get)
+    gp = GooglePlaces.GooglePlaces('key')
+    yield gp
+    release.set()
+    gp.executor.shutdown(wait=True)
+    gp.search_executor.shutdown(wait=True)
+
+def test_slow_details_call_leaves_budget_for_scoring(google):
+    deadline = Deadline(1.5)
+    reviews = google.retrieve_reviews_multi(['park'], [43.7, -79.4], deadline.reserve(0.5),
+                                            text_queries=['playground'])
+    assert sorted([review['result']['name'] for review in reviews]) == ['fast1', 'fast2']
+    assert deadline.partial
+    assert not deadline.expired()
+    assert deadline.remaining() > 0.3
+
+def test_no_placeholder_result_with_deadline(google, monkeypatch):
+    monkeypatch.setattr(GooglePlaces.requests, 'get', lambda *args, **kwargs: FakeResponse({'results' : []}))
+    assert google.retrieve_reviews_multi(['park'], [43.7, -79.4], Deadline(1.0)) == []
+
+def test_admission_ignores_counts_of_exited_workers(tmp_path):
+    pytest.importorskip('psutil')
+    # A worker killed mid-request whose process ID has been reused
+    stale = tmp_path / '{}-{:.2f}'.format(os.getppid(), time.time() - 3600)
+    stale.write_text('1')
+    control = AdmissionControl(1, 2, str(tmp_path))
+    assert control.total_inflight() == 0
+    assert not stale.exists()
+    assert control.admit() == AdmissionControl.ADMIT
+    assert control.admit() == AdmissionControl.DEGRADE
+    assert control.admit() == AdmissionControl.REJECT
+
+def test_text_search_results_outside_radius_are_dropped(google, monkeypatch):
+    def fake_get(endpoint_url, params=None, timeout=None):
+        if 'nearbysearch' in endpoint_url:
+            return FakeResponse({'results' : [{'place_id' : 'park'}]})
+        if 'textsearch' in endpoint_url:
+            return FakeResponse({'results' : [
+                    {'place_id' : 'near', 'geometry' : {'location' : {'lat' : 43.71, 'lng' : -79.4}}},
+                    {'place_id' : 'far', 'geometry' : {'location' : {'lat' : 43.9, 'lng' : -79.4}}}]})
+        return FakeResponse({'result' : {'name' : params['place_id']}})
+    monkeypatch.setattr(GooglePlaces.requests, 'get', fake_get)
+    google.search_radius = 5000
+    reviews = google.retrieve_reviews_multi(['park'], [43.7, -79.4], Deadline(1.0), text_queries=['playground'])
+    assert sorted([review['result']['name'] for review in reviews]) == ['near', 'park']
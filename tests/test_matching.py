@@ -0,0 +1,78 @@
+"""Checks match_records against brute_force_match on Toronto-style park data"""
+
+import math
+import random
+import pytest
+
+pytest.importorskip('fuzzywuzzy')
+import matching
+
+first_words = ['Dufferin', 'Willow', 'Riverdale', 'East', 'West', 'High', 'Grange', 'Trinity',
+               'Bellwoods', 'Christie', 'Pits', 'Withrow', 'Dovercourt', 'Wychwood', 'Barns',
+               'Sorauren', 'Monarch', 'Greenwood', 'Jimmie', 'Simpson', 'Oriole', 'Eglinton',
+               'St', 'James', 'Ramsden', 'Rosedale', 'Marie', 'Curtis', 'Leslie', 'Grove']
+kinds = ['Park', 'Pk', 'Parkette', 'CC', 'CRC', 'Rec Centre', 'Playground', 'Green', 'Square',
+         'Community Centre', 'Ravine', 'Commons', '']
+
+def park_names(rng, count):
+    names = []
+    for _ in range(count):
+        words = rng.sample(first_words, rng.choice([1, 1, 2, 3]))
+        names.append(' '.join(words + [rng.choice(kinds)]).strip())
+    return names
+
+def park_records(rng, names, center=(43.70, -79.40), spread=0.02):
+    records = []
+    for name in names:
+        record = {'name' : name}
+        if rng.random() > 0.05:
+            record['lat'] = center[0] + rng.uniform(-spread, spread)
+            record['lng'] = center[1] + rng.uniform(-spread, spread)
+        records.append(record)
+    return records
+
+@pytest.mark.parametrize('threshold', [30, 50, 75, 90])
+def test_match_records_same_as_brute_force(threshold):
+    rng = random.Random(threshold)
+    left = park_records(rng, park_names(rng, 150))
+    right = park_records(rng, park_names(rng, 150))
+    expected = matching.brute_force_match(left, right, threshold)
+    assert matching.match_records(left, right, threshold) == expected
+
+def test_match_records_without_distance_check():
+    rng = random.Random(0)
+    left = park_records(rng, park_names(rng, 80) + ['East'])
+    right = park_records(rng, park_names(rng, 80) + ['Rec Dufferin Willow'])
+    expected = matching.brute_force_match(left, right, 50, max_distance_km=None)
+    assert ('east', 'recreation dufferin willow') in [
+        (matching.normalize_name(left[ii]['name']), matching.normalize_name(right[jj]['name']))
+        for ii, jj, _ in expected]
+    assert matching.match_records(left, right, 50, max_distance_km=None) == expected
+
+@pytest.mark.parametrize('lat', [0.0, 43.7, 70.0])
+def test_match_records_across_cell_boundaries(lat):
+    # Pairs just inside max_distance_km, straddling many cell boundaries
+    rng = random.Random(1)
+    left, right = [], []
+    for _ in range(200):
+        bearing = rng.uniform(0, 2*math.pi)
+        distance = 0.9995 / matching.earth_radius_km
+        lat1 = lat + rng.uniform(-0.05, 0.05)
+        lng1 = -79.4 + rng.uniform(-0.05, 0.05)
+        lat2 = lat1 + math.degrees(distance*math.cos(bearing))
+        lng2 = lng1 + math.degrees(distance*math.sin(bearing)/math.cos(math.radians(lat1)))
+        left.append({'name' : 'Trinity Bellwoods Park', 'lat' : lat1, 'lng' : lng1})
+        right.append({'name' : 'Trinity Bellwoods Park', 'lat' : lat2, 'lng' : lng2})
+    expected = matching.brute_force_match(left, right, 90)
+    assert len(expected) >= len(left)
+    assert matching.match_records(left, right, 90) == expected
+
+def test_match_records_custom_scorer():
+    rng = random.Random(2)
+    left = park_records(rng, park_names(rng, 60))
+    right = park_records(rng, park_names(rng, 60))
+    expected = matching.brute_force_match(left, right, 1, scorer=length_scorer)
+    assert matching.match_records(left, right, 1, scorer=length_scorer) == expected
+
+def length_scorer(name1, name2):
+    return 100 - abs(len(name1) - len(name2))
@@ -0,0 +1,335 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+.....................Model training pipeline for PLAYGROUNDr....................
+Author: James Bramante
+Date: February 14, 2020
+
+This script trains the models used by the PLAYGROUNDr web app, following the
+winning approach in PLAYGROUNDr_model_training.ipynb: a TF-IDF vectorizer
+(unigrams + bigrams, 2,000 most frequent terms) feeding one cross-validated
+logistic regression per amenity.
+
+Compared to rerunning the notebook, it
+    - cleans (text_prepare) the review corpus in parallel processes,
+    - caches the cleaned text of each review document on disk, keyed by a
+      hash of the document, so a rerun after a small data change only
+      cleans the documents that changed,
+    - caches the fitted vectorizer and sparse TF-IDF matrix, keyed by a hash
+      of the cleaned documents and parameters, so they are only rebuilt when
+      their inputs change,
+    - fits the per-amenity models, and their regularization grid searches,
+      concurrently across cores.
+
+It writes classifier.mod and TFIDFmodel.mod to the output directory, and can
+instead publish them as a new version in the ModelRegistry, e.g.
+
+    python train.py labeled.json --corpus reviews.json --publish
+
+This script requires numpy, scipy, scikit-learn, joblib, and the util module.
+"""
+
+from multiprocessing import Pool
+import argparse
+import hashlib
+import os
+import pickle
+import time
+from joblib import Parallel, delayed
+from scipy import sparse
+from sklearn import metrics
+from sklearn.feature_extraction.text import TfidfVectorizer
+from sklearn.linear_model import LogisticRegressionCV
+import numpy as np
+import pandas as pd
+import util
+
+cache_version = 1 # Increment to invalidate caches after changing text_prepare
+default_cache_dir = "data/cache"
+default_output_dir = "data"
+
+# TF-IDF parameters, as used for the deployed model
+tfidf_params = {
+        'input' : 'content',
+        'ngram_range' : (1,2),
+        'max_df' : 0.9,
+        'min_df' : 5,
+        'max_features' : 2000
+        }
+
+# Logistic regression parameters, as used in the training notebook
+num_Cs = 20 #Number of regularization parameters to try in range 1e-4:1e4
+num_folds = 5
+
+document_cache_name = "cleaned_documents.pkl" # Per-document text_prepare cache
+
+def document_key(document):
+    """Returns the cache key for one raw review document"""
+    return hashlib.sha256('{}|{}'.format(cache_version, document).encode()).hexdigest()
+
+def cache_key(*parts):
+    """Combines strings into a short cache key"""
+    return hashlib.sha256('|'.join([str(cache_version)]+[str(part) for part in parts]).encode()).hexdigest()[:16]
+
+def prepare_corpus(documents, n_jobs, chunksize=64):
+    """Cleans a list of documents with util.text_prepare in parallel processes
+
+    Parameters
+    ----------
+    documents : list
+        raw review documents
+    n_jobs : int
+        number of worker processes
+    chunksize : int, optional
+        documents sent to a worker at a time. The default is 64.
+
+    Returns
+    -------
+    list
+        cleaned review documents, in the same order
+
+    """
+    if n_jobs <= 1:
+        return [util.text_prepare(doc) for doc in documents]
+    with Pool(n_jobs) as pool:
+        return pool.map(util.text_prepare, documents, chunksize)
+
+def load_document_cache(cache_dir):
+    """Loads the per-document cache of cleaned review text
+
+    Parameters
+    ----------
+    cache_dir : str
+        cache directory
+
+    Returns
+    -------
+    dict
+        document_key : cleaned document
+
+    """
+    cache_file = os.path.join(cache_dir,document_cache_name)
+    if os.path.isfile(cache_file):
+        with open(cache_file,'rb') as fp:
+            return pickle.load(fp)
+    return {}
+
+def save_document_cache(cache, cache_dir, keep=None):
+    """Saves the per-document cache of cleaned review text
+
+    Parameters
+    ----------
+    cache : dict
+        document_key : cleaned document
+    cache_dir : str
+        cache directory
+    keep : set, optional
+        keys to keep. Entries for documents no longer in the data are
+        dropped. The default keeps every entry.
+
+    Returns
+    -------
+    None.
+
+    """
+    if keep is not None:
+        cache = {key : cache[key] for key in keep if key in cache}
+    cache_file = os.path.join(cache_dir,document_cache_name)
+    with open(cache_file + '.tmp','wb') as fp:
+        pickle.dump(cache, fp)
+    os.replace(cache_file + '.tmp', cache_file)
+
+def cached_corpus(documents, cache, n_jobs):
+    """Cleans documents, reusing cleaned text cached for unchanged documents
+
+    Only documents missing from the cache are cleaned, in parallel, and
+    added to the cache.
+
+    Parameters
+    ----------
+    documents : list
+        raw review documents
+    cache : dict
+        document_key : cleaned document. Updated in place
+    n_jobs : int
+        number of worker processes for cleaning
+
+    Returns
+    -------
+    cleaned : list
+        cleaned review documents, in the same order
+    keys : list
+        document_key of each document
+
+    """
+    keys = [document_key(doc) for doc in documents]
+    missing = {}
+    for key, doc in zip(keys, documents):
+        if key not in cache:
+            missing[key] = doc
+    if missing:
+        cleaned = prepare_corpus(list(missing.values()), n_jobs)
+        cache.update(zip(missing.keys(), cleaned))
+    print("  cleaned {} new of {} documents".format(len(missing), len(documents)))
+    return ([cache[key] for key in keys], keys)
+
+def cached_features(corpus, X, key, cache_dir):
+    """Loads the fitted vectorizer and TF-IDF matrix from cache, or builds them
+
+    Parameters
+    ----------
+    corpus : list
+        cleaned documents on which to fit the vectorizer
+    X : list
+        cleaned labeled documents to vectorize
+    key : str
+        cache key identifying corpus, X, and the vectorizer parameters
+    cache_dir : str
+        cache directory
+
+    Returns
+    -------
+    tfidf_model : sklearn.TfidfVectorizer
+        the fitted vectorizer
+    X_tfidf : scipy.sparse.csr_matrix
+        TF-IDF features for X
+
+    """
+    vectorizer_file = os.path.join(cache_dir,'tfidf_{}.pkl'.format(key))
+    matrix_file = os.path.join(cache_dir,'tfidf_{}.npz'.format(key))
+    if os.path.isfile(vectorizer_file) and os.path.isfile(matrix_file):
+        with open(vectorizer_file,'rb') as fp:
+            tfidf_model = pickle.load(fp)
+        return (tfidf_model, sparse.load_npz(matrix_file))
+    tfidf_model = TfidfVectorizer(**tfidf_params).fit(corpus)
+    X_tfidf = tfidf_model.transform(X).tocsr()
+    # np.savez appends .npz to names that lack it, so write via a file object
+    with open(matrix_file + '.tmp','wb') as fp:
+        sparse.save_npz(fp, X_tfidf)
+    os.replace(matrix_file + '.tmp', matrix_file)
+    with open(vectorizer_file + '.tmp','wb') as fp:
+        pickle.dump(tfidf_model, fp)
+    os.replace(vectorizer_file + '.tmp', vectorizer_file)
+    return (tfidf_model, X_tfidf)
+
+def fit_amenity(X_tfidf, y, n_jobs, seed):
+    """Fits a cross-validated logistic regression for one amenity
+
+    Parameters
+    ----------
+    X_tfidf : scipy.sparse.csr_matrix
+        TF-IDF features
+    y : numpy.array
+        0/1 labels for the amenity
+    n_jobs : int
+        number of cores for the regularization grid search
+    seed : int
+        random seed, for reproducibility
+
+    Returns
+    -------
+    sklearn.linear_model.LogisticRegressionCV
+        the fitted model
+
+    """
+    f2_score = metrics.make_scorer(metrics.fbeta_score,beta=0.5)
+    lrc = LogisticRegressionCV(cv=num_folds, Cs=num_Cs, class_weight='balanced', solver='liblinear',
+                               max_iter=1000, dual=True, scoring=f2_score, refit=True,
+                               n_jobs=n_jobs, random_state=seed)
+    return lrc.fit(X_tfidf, y)
+
+def train(labeled_file, corpus_file=None, cache_dir=default_cache_dir, n_jobs=-1, seed=0):
+    """Trains the TF-IDF vectorizer and per-amenity classifiers
+
+    Parameters
+    ----------
+    labeled_file : str
+        labeled review database (see util.load_labeled_reviews)
+    corpus_file : str, optional
+        review database (JSON lines with a 'reviews' column) on which to fit
+        the vectorizer. The default is labeled_file.
+    cache_dir : str, optional
+        directory for cached corpora and features. The default is
+        default_cache_dir.
+    n_jobs : int, optional
+        number of cores to use. The default (-1) uses all cores.
+    seed : int, optional
+        random seed. The default is 0.
+
+    Returns
+    -------
+    clf : list
+        one fitted classifier per amenity in util.amenity_vars
+    tfidf_model : sklearn.TfidfVectorizer
+        the fitted vectorizer
+
+    """
+    if n_jobs < 1:
+        n_jobs = os.cpu_count() or 1
+    os.makedirs(cache_dir, exist_ok=True)
+    timer = time.perf_counter()
+
+    # Clean the labeled reviews and remove those emptied by the cleaning
+    document_cache = load_document_cache(cache_dir)
+    X, y = util.load_labeled_reviews(labeled_file)
+    X, labeled_keys = cached_corpus(X, document_cache, n_jobs)
+    labeled_key = cache_key(*labeled_keys)
+    y = np.array([y[ii,:] for ii in range(len(X)) if X[ii]])
+    X = [x for x in X if x]
+    print("Cleaned {} labeled documents ({:.1f} s)".format(len(X), time.perf_counter()-timer))
+
+    # Clean the vectorizer corpus
+    if corpus_file and corpus_file != labeled_file:
+        corpus = list(pd.read_json(corpus_file,orient='records',lines='True')['reviews'])
+        corpus, corpus_keys = cached_corpus([str(doc) for doc in corpus], document_cache, n_jobs)
+        corpus_key = cache_key(*corpus_keys)
+    else:
+        corpus_keys = []
+        corpus_key = labeled_key
+        corpus = X
+    save_document_cache(document_cache, cache_dir, set(labeled_keys) | set(corpus_keys))
+    print("Cleaned {} corpus documents ({:.1f} s)".format(len(corpus), time.perf_counter()-timer))
+
+    # Fit the vectorizer and build the feature matrix
+    features_key = cache_key(labeled_key, corpus_key, sorted(tfidf_params.items()))
+    tfidf_model, X_tfidf = cached_features(corpus, X, features_key, cache_dir)
+    print("Built {} x {} TF-IDF matrix ({:.1f} s)".format(X_tfidf.shape[0], X_tfidf.shape[1], time.perf_counter()-timer))
+
+    # Fit all amenities at once, splitting the remaining cores among each
+    # amenity's cross-validation folds
+    num_models = y.shape[1]
+    outer_jobs = min(n_jobs, num_models)
+    inner_jobs = max(1, n_jobs // outer_jobs)
+    clf = Parallel(n_jobs=outer_jobs)(
+            delayed(fit_amenity)(X_tfidf, y[:,ii], inner_jobs, seed) for ii in range(num_models))
+    for name, lrc in zip(util.amenity_vars, clf):
+        print("  {:<14} C = {:.4g}".format(name, lrc.C_[0]))
+    print("Fit {} amenity models ({:.1f} s)".format(num_models, time.perf_counter()-timer))
+    return (clf, tfidf_model)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Train the PLAYGROUNDr amenity models")
+    parser.add_argument('labeled', help="labeled review database (JSON lines)")
+    parser.add_argument('--corpus', default=None,
+                        help="review database on which to fit the TF-IDF vectorizer (default: labeled)")
+    parser.add_argument('--cache-dir', default=default_cache_dir, help="directory for cached features")
+    parser.add_argument('--output-dir', default=default_output_dir,
+                        help="directory to which classifier.mod and TFIDFmodel.mod are written")
+    parser.add_argument('--publish', action='store_true',
+                        help="publish to the model registry instead of --output-dir")
+    parser.add_argument('--version', default=None, help="version name when publishing")
+    parser.add_argument('--n-jobs', type=int, default=-1, help="number of cores (default: all)")
+    parser.add_argument('--seed', type=int, default=0, help="random seed")
+    args = parser.parse_args()
+
+    clf, tfidf_model = train(args.labeled, args.corpus, args.cache_dir, args.n_jobs, args.seed)
+    if args.publish:
+        version = util.model_registry.publish(clf, tfidf_model, args.version)
+        print("Published model version {}".format(version))
+    else:
+        os.makedirs(args.output_dir, exist_ok=True)
+        with open(os.path.join(args.output_dir,os.path.basename(util.model_file_name)),'wb') as fp:
+            pickle.dump(clf, fp)
+        with open(os.path.join(args.output_dir,os.path.basename(util.vectorizer_file_name)),'wb') as fp:
+            pickle.dump(tfidf_model, fp)
+        print("Wrote models to {}".format(args.output_dir))
@@ -8,14 +8,16 @@ Date: January 24, 2020
 This script can be imported as a module and contains utility methods for the 
 PLAYGROUNDr web app to process Google Reviews and implement NLP models
 
-This script requires gensim, nltk, numpy, pandas, and pickle for pickled models
+This script requires gensim, nltk, numpy, and pandas. Pickled models are loaded
+through the ModelRegistry, which allows new model versions to be swapped in
+while the app is running.
 """
 #import nltk
 #nltk.download('stopwords')
 from gensim.models import FastText
 from nltk.corpus import stopwords
 from nltk.stem import WordNetLemmatizer
-import pickle
+from ModelRegistry import ModelRegistry
 import numpy as np
 import pandas as pd
 import re
@@ -35,23 +37,22 @@ train_epochs = 5
 num_amenities = 7 # Number of amenities predicted by the classifier
 min_num_reviews = 4 # Minimimum number of reviews to accept before running model
 amenity_names = ['Playground','Sports field','Pool','Splash pad','Ice rink', 'Dog park']
+amenity_vars = ['playground', 'sports_field','pool','splashpad','rink','dog_park'] # Database columns for amenity_names
 model_file_name = "data/classifier.mod" # Filename containing the classification model
 vectorizer_file_name = "data/TFIDFmodel.mod"
+model_registry_dir = "data/models" # Directory of versioned model directories
 
 ## Some additional parsing/kluges help the app perform better
 # If these words appear in the location name, don't throw out if Google fails
 # to label as park
 place_types = ['playground','pool', 'dog park', 'dog run', 'rink', 'recreation centre', 'community centre','recreation center', 'community center', 'sports field']
 
-# Load the string encoder model and amenity classification model
-with open(model_file_name,'rb') as fp:
-    clf = pickle.load(fp)
-    
-with open(vectorizer_file_name,'rb') as fp:
-    tfidf_model = pickle.load(fp)
+# Registry for the string encoder model and amenity classification model. The
+# legacy model files are used until a versioned model is published
+model_registry = ModelRegistry(model_registry_dir, (model_file_name, vectorizer_file_name))
 
 
-def process_review(review):
+def process_review(review, models=None):
     """Apply a classification model to review text to predict amenities
     
 
@@ -60,6 +61,10 @@ def process_review(review):
     review : dict
         JSON dict output from Google Places request for reviews. The first 
         name should be 'results', and its value should contain all other info
+    models : ModelRegistry.ModelSet, optional
+        models to apply. The default is the registry's active ModelSet. Pass
+        the same ModelSet for every review in a request so that all of them
+        are scored by one model version.
 
     Returns
     -------
@@ -70,6 +75,9 @@ def process_review(review):
         
     """
     
+    if models is None:
+        models = model_registry.current()
+    
     # Set default outputs
     out_name = review['name']
     out_text = ""
@@ -77,7 +85,10 @@ def process_review(review):
     out_address = review['formatted_address']
     out_location = review['geometry']['location']
     
-    if "park" not in review['types'] and not any([place_type in review["name"].lower() for place_type in place_types]):
+    # Places found by an amenity text search are kept even if Google doesn't
+    # label them as parks
+    found_by_text = any([prov.startswith('text:') for prov in review.get('search_provenance', [])])
+    if "park" not in review['types'] and not found_by_text and not any([place_type in review["name"].lower() for place_type in place_types]):
         out_text = "This site is not a park; results may be invalid."
     
     # If there are no reviews, don't run the model    
@@ -96,9 +107,9 @@ def process_review(review):
             # Clean the text
             reviews_text = ' '.join(reviews_text)
             # Vectorize the text
-            X_vect = tfidf_vectorize(reviews_text,tfidf_model)
+            X_vect = tfidf_vectorize(reviews_text,models.tfidf_model)
             # Run the classification model
-            y_pred = [clf[ii].predict(X_vect[0,:])[0] for ii in range(len(clf))]
+            y_pred = [models.clf[ii].predict(X_vect[0,:])[0] for ii in range(len(models.clf))]
             out_scores = [str(y_pred[ii]) for ii in range(len(y_pred))]
             # If the amenity name appears in the location name, it should
             # probably be at that location
@@ -113,7 +124,9 @@ def process_review(review):
         'scores' : out_scores,
         'amenities' : amenity_names,
         'location' : out_location,
-        'distance' : str(0)
+        'distance' : str(0),
+        'model_version' : models.version,
+        'provenance' : review.get('search_provenance', [])
                 }
     return out_dict
 
@@ -180,6 +193,33 @@ def tfidf_vectorize(words,tfidf):
     """
     return tfidf.transform([words])
 
+def w2v_vectorize(words,wv):
+    """
+    Vectorizes text by averaging word2vec (FastText) word vectors
+
+    Parameters
+    ----------
+    words : str
+        A review document (a string containing one or more reviews)
+    wv : gensim.models.keyedvectors.KeyedVectors
+        Word vectors, e.g. the output of build_fasttext_model
+
+    Returns
+    -------
+    vect : numpy.array
+        A 1 x vector_size array containing the mean vector of the words that
+        wv has vectors for. Other words are skipped (FastText vectors cover
+        unseen words, plain KeyedVectors don't)
+
+    """
+    tokens = [word for word in words.split() if word in wv]
+    vect = np.zeros([1,wv.vector_size])
+    for word in tokens:
+        vect[0,:] += wv[word]
+    if tokens:
+        vect /= len(tokens)
+    return vect
+
 def build_fasttext_model(full_database_file):
     """
     Trains a word2vec model from scratch
@@ -213,4 +253,28 @@ def build_fasttext_model(full_database_file):
     w2v_model.build_vocab(X_vector_train)
     w2v_model.train(X_vector_train,total_examples=w2v_model.corpus_count,epochs=train_epochs)
     w2v_model.init_sims(replace=True)
-    return w2v_model.wv
\ No newline at end of file
+    return w2v_model.wv
+
+def load_labeled_reviews(labeled_database_file):
+    """
+    Loads review documents and amenity labels from a labeled review database
+
+    Parameters
+    ----------
+    labeled_database_file : str
+        JSON lines file with one park per line. Each line should contain a
+        'reviews' string and a 0/1 column for each of amenity_vars, as in the
+        database prepared in PLAYGROUNDr_model_training.ipynb
+
+    Returns
+    -------
+    X : list
+        list of raw (not yet cleaned) review documents
+    y : numpy.array
+        N x len(amenity_vars) array of amenity labels
+
+    """
+    labeled_database = pd.read_json(labeled_database_file,orient='records',lines='True')
+    X = [str(x) for x in labeled_database['reviews']]
+    y = np.array(labeled_database.loc[:,amenity_vars]).astype(int)
+    return (X, y)
\ No newline at end of file